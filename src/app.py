@@ -1,4 +1,7 @@
+import json
+import os
 import time
+import flask
 import dash
 from dash import Dash, dcc, html
 import dash_bootstrap_components as dbc
@@ -6,11 +9,33 @@ from dash import html
 import dash_loading_spinners
 from dash.exceptions import PreventUpdate
 from dash.dependencies import Input, Output, State
-from model.Updater import ParquetUpdater
+from model.Updater import ParquetUpdater, JOBS_METRICS, readiness
+from model.Alarms import Alarms
+from model.SiteDirectory import SiteDirectory
+from model.MeasuresStore import MeasuresStore
+from utils.parquet import releaseReplaced
+from utils.memo import releasePages
+import utils.snapshot as snapshot
 
 
 # cache the data in /parquet.
-ParquetUpdater()
+# The app is served at once: the previous snapshot is used while the cache is refreshed in the background.
+# With UPDATER=external the cache is written by a separate process (updater.py)
+# and the web workers only read it
+if os.environ.get('UPDATER', 'embedded') == 'external':
+    updater = None
+else:
+    updater = ParquetUpdater()
+# the listeners share one watch thread and are called in this order on each new snapshot generation:
+# drop the cached frames replaced by the generation and the page payloads built from the previous ones
+snapshot.watch(releaseReplaced)
+snapshot.watch(releasePages)
+# index the alarms of the generation for the "other alarms" of the alarm pages
+snapshot.watch(Alarms().indexGeneration)
+# index the metadata of the hosts of the generation
+snapshot.watch(SiteDirectory.loadGeneration)
+# partition the measurements of the generation for the site plots
+snapshot.watch(MeasuresStore.loadGeneration)
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css',
                         "https://cdnjs.cloudflare.com/ajax/libs/font-awesome/5.15.1/css/all.min.css",
@@ -23,11 +48,30 @@ app = Dash(__name__, external_stylesheets=external_stylesheets,
            suppress_callback_exceptions=True, use_pages=True)
 
 
-# Kubernetes rediness probe
+# Kubernetes rediness probe. The app is ready as soon as it serves,
+# the status of each dataset is returned as well (see model.Updater.readiness).
+# With ?dataset=<name> it responds with 503 until that dataset can be served
 server = app.server
 @server.route('/ready')
 def ready():
-    return 'OK', 200
+    status = updater.readiness() if updater is not None else readiness()
+    dataset = flask.request.args.get('dataset')
+    if dataset is not None:
+        ok = status.get(dataset) in ['ready', 'stale']
+        return flask.jsonify({dataset: status.get(dataset)}), 200 if ok else 503
+    return flask.jsonify(status), 200
+
+
+# State, last duration and last success of the updater jobs
+@server.route('/jobs')
+def jobs():
+    if updater is not None:
+        return flask.jsonify(updater.scheduler.metrics())
+    try:
+        with open(f'{snapshot.LOCATION}{JOBS_METRICS}') as f:
+            return flask.jsonify(json.load(f))
+    except FileNotFoundError:
+        return flask.jsonify({}), 404
 
 
 nav_item_inline_css = {"color": "white",
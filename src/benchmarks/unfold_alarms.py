@@ -0,0 +1,105 @@
+import random
+import time
+
+import pandas as pd
+
+from model.Alarms import Alarms
+
+# Compares the unfolding of Alarms.unpackAlarms with the previous row-by-row implementation
+# on a synthetic month of alarms and checks that both produce the same pivot frames.
+# Run from src/:
+#   python3 -m benchmarks.unfold_alarms
+SITES = [f'SITE-{i}' for i in range(300)]
+DAYS = 30
+
+
+def syntheticAlarms(perDay, seed=42):
+    rnd = random.Random(seed)
+    dates = pd.date_range('2024-01-01', periods=DAYS*perDay, freq=f'{24*60*60//perDay}s', tz='UTC')
+    sample = lambda: rnd.sample(SITES, rnd.randint(0, 8))
+
+    loss, tags, unreachable = [], [], []
+    for i, to in enumerate(dates):
+        frm = to - pd.Timedelta(hours=24)
+        dests, srcs = sample(), sample()
+        loss.append({'from': frm, 'to': to, 'site': rnd.choice(SITES), 'tag': [rnd.choice(SITES)],
+                     'dest_sites': dests, 'dest_loss': [round(rnd.random()*100, 2) for _ in dests],
+                     'src_sites': srcs, 'src_loss': [round(rnd.random()*100, 2) for _ in srcs],
+                     'ipv6': rnd.random() > 0.5})
+        tags.append({'from': frm, 'to': to, 'tag': sample() or [rnd.choice(SITES)], 'value': rnd.random()})
+        unreachable.append({'from': frm, 'to': to, 'site': rnd.choice(SITES), 'tag': [rnd.choice(SITES)],
+                            'cannotBeReachedFrom': sample()})
+
+    def frame(records):
+        df = pd.DataFrame(records)
+        df['id'] = df.index
+        return df
+
+    return frame(loss), frame(tags), frame(unreachable)
+
+
+# The implementations replaced by the columnar ones.
+# dropna() keeps the result of stack() before pandas 3, which no longer drops the missing values
+def list2rowsApply(df):
+    s = df.apply(lambda x: pd.Series(x['tag']), axis=1).stack().dropna().reset_index(level=1, drop=True)
+    s.name = 'tag'
+    return df.drop('tag', axis=1).join(s)
+
+
+def one2manyUnfoldApply(odf, fld, fldNewName, listSites, listedNewName):
+    s = odf.apply(lambda x: pd.Series(x[listSites]), axis=1).stack().dropna().reset_index(level=1, drop=True)
+    s.name = listedNewName
+    odf = odf.join(s)
+    odf[fldNewName] = odf[fld]
+    return odf
+
+
+def oneInBothWaysUnfoldRecords(odf):
+    data = []
+    for r in odf.to_dict('records'):
+        for i, dest_site in enumerate(r['dest_sites']):
+            rec = {'from': r['from'], 'to': r['to'], 'dest_site': dest_site,
+                   'src_site': r['site'], 'id': r['id'], 'tag': r['tag'][0]}
+            if 'dest_loss' in r.keys():
+                rec['dest_loss'] = r['dest_loss'][i]
+            elif 'dest_change' in r.keys():
+                rec['dest_change'] = r['dest_change'][i]
+            if 'ipv6' in r.keys():
+                rec['ipv6'] = r['ipv6']
+            data.append(rec)
+        for i, src_site in enumerate(r['src_sites']):
+            rec = {'from': r['from'], 'to': r['to'], 'src_site': src_site,
+                   'dest_site': r['site'], 'id': r['id'], 'tag': r['tag'][0]}
+            if 'src_loss' in r.keys():
+                rec['src_loss'] = r['src_loss'][i]
+            elif 'src_change' in r.keys():
+                rec['src_change'] = r['src_change'][i]
+            if 'ipv6' in r.keys():
+                rec['ipv6'] = r['ipv6']
+            data.append(rec)
+    return pd.DataFrame(data)
+
+
+def measure(name, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    print(f"{name:<40} {time.perf_counter() - start:8.3f} secs  {len(result):>9} rows")
+    return result
+
+
+if __name__ == '__main__':
+    loss, tags, unreachable = syntheticAlarms(perDay=2000)
+    print(f"{DAYS} days, {len(loss)} alarms per event\n")
+
+    cases = [('oneInBothWaysUnfold', oneInBothWaysUnfoldRecords, Alarms.oneInBothWaysUnfold, (loss,)),
+             ('list2rows', list2rowsApply, Alarms.list2rows, (tags,)),
+             ('one2manyUnfold', one2manyUnfoldApply, Alarms.one2manyUnfold,
+              (unreachable, 'site', 'dest_site', 'cannotBeReachedFrom', 'src_site'))]
+
+    for name, before, after, args in cases:
+        expected = measure(f'{name} (before)', before, *args)
+        result = measure(f'{name}', after, *args)
+        # object and str columns holding the same values are equal
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+        print()
+    print("The pivot frames are identical.")
@@ -7,14 +7,15 @@ from utils.helpers import timer
 @timer
 def loadPacketLossData(dateFrom, dateTo, batch_size=10000):
     data = []
-    intv = int(hp.CalcMinutes4Period(dateFrom, dateTo) / 60)
-    time_list = hp.GetTimeRanges(dateFrom, dateTo, intv)
-    for i in range(len(time_list) - 1):
-        print(f' {i+1}/{len(time_list)-1} packetloss query', time_list[i], time_list[i + 1])
-        data.extend(qrs.query4Avg('ps_packetloss', time_list[i], time_list[i + 1]))
-        if len(data) >= batch_size:
-            yield pd.DataFrame(data)
-            data = []
+    # hourly averages, requested one day at a time
+    windows = hp.GetTimeWindows(dateFrom, dateTo, 24*60)
+    for i, (wFrom, wTo) in enumerate(windows):
+        print(f' {i+1}/{len(windows)} packetloss query', wFrom, wTo)
+        for page in qrs.query4AvgPages('ps_packetloss', wFrom, wTo, interval=60):
+            data.extend(page)
+            if len(data) >= batch_size:
+                yield pd.DataFrame(data)
+                data = []
     if data:
         yield pd.DataFrame(data)
 
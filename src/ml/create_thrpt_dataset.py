@@ -8,13 +8,13 @@ import utils.helpers as hp
 
 def queryData(dateFrom, dateTo):
     data = []
-    # query in portions since ES does not allow aggregations with more than 10000 bins
-    intv = int(hp.CalcMinutes4Period(dateFrom, dateTo) / 60)
-    time_list = hp.GetTimeRanges(dateFrom, dateTo, intv)
+    # hourly averages, requested one day at a time. The aggregation is paged,
+    # so the buckets are not limited to 10000 per request
+    windows = hp.GetTimeWindows(dateFrom, dateTo, 24*60)
     print(dateFrom, dateTo)
-    for i in range(len(time_list) - 1):
-        print(f' {i+1}/{len(time_list)-1} throughput query', time_list[i], time_list[i + 1])
-        data.extend(qrs.queryThroughputIdx(time_list[i], time_list[i + 1]))
+    for i, (wFrom, wTo) in enumerate(windows):
+        print(f' {i+1}/{len(windows)} throughput query', wFrom, wTo)
+        data.extend(qrs.queryThroughputIdx(wFrom, wTo, interval=60))
 
     return data
 
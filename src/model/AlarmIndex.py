@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+
+
+# In-memory index of the pivot alarms, used to find the other alarms of a site or a pair of sites.
+# Per event the rows are sorted by "to" and their positions are grouped by tag and by (src_site, dest_site),
+# so a lookup is a hash lookup followed by a binary search of the period.
+# The positions of a group are increasing, thus the "to" values of each group are sorted as well
+class AlarmIndex(object):
+
+    def __init__(self, pivotFrames):
+        self.events = {}
+        for event, df in pivotFrames.items():
+            if len(df) == 0 or 'to' not in df.columns:
+                continue
+            df = df.sort_values('to', kind='stable')
+            to = pd.to_datetime(df['to'], utc=True).astype('datetime64[ns, UTC]')
+            entry = {'to': to.astype('int64').to_numpy(), 'id': df['id'].to_numpy(), 'tag': {}, 'pair': None}
+            if 'tag' in df.columns:
+                entry['tag'] = self.groups(df['tag'])
+            if 'src_site' in df.columns and 'dest_site' in df.columns:
+                entry['pair'] = self.groups(df['src_site'], df['dest_site'])
+            self.events[event] = entry
+
+    # Only the string values can match a site, the rest (e.g. the tags of the events
+    # which are not unfolded) are left out of the groups
+    @staticmethod
+    def strings(values):
+        if pd.api.types.infer_dtype(values, skipna=True) == 'string':
+            return values
+        return values.where(values.map(lambda x: isinstance(x, str)))
+
+    # The increasing positions of the rows per value (or tuple of values) of the given columns
+    @staticmethod
+    def groups(*columns):
+        values = [AlarmIndex.strings(col).to_numpy(dtype=object) for col in columns]
+        valid = np.flatnonzero(np.logical_and.reduce([pd.notna(v) for v in values]))
+        keys = values[0][valid] if len(values) == 1 else pd.MultiIndex.from_arrays([v[valid] for v in values])
+        codes, uniques = pd.factorize(keys)
+        order = np.argsort(codes, kind='stable')
+        bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+        return {key: valid[order[bounds[i]:bounds[i+1]]] for i, key in enumerate(uniques)}
+
+    # The number of unique alarms of the positions which end between dateFrom and dateTo (in ns)
+    @staticmethod
+    def count(entry, positions, dateFrom, dateTo):
+        to = entry['to'][positions]
+        start, end = np.searchsorted(to, dateFrom, 'left'), np.searchsorted(to, dateTo, 'right')
+        return len(pd.unique(entry['id'][positions[start:end]]))
+
+    # The number of alarms per event, other than currEvent, for the pair of sites when the event has
+    # the src_site and dest_site columns, otherwise for the site
+    def otherAlarms(self, currEvent, dateFrom, dateTo, site=None, src_site=None, dest_site=None):
+        dateFrom, dateTo = pd.to_datetime(dateFrom, utc=True).value, pd.to_datetime(dateTo, utc=True).value
+        alarmsListed = {}
+        for event, entry in self.events.items():
+            if event == currEvent:
+                continue
+            if src_site is not None and dest_site is not None and entry['pair'] is not None:
+                positions = entry['pair'].get((src_site.upper(), dest_site.upper()))
+            elif site is not None:
+                positions = entry['tag'].get(site.upper())
+            else:
+                continue
+            if positions is not None:
+                cnt = self.count(entry, positions, dateFrom, dateTo)
+                if cnt > 0:
+                    alarmsListed[event] = cnt
+        return alarmsListed
@@ -1,5 +1,7 @@
 import glob
+import json
 import os
+import threading
 import time
 import numpy as np
 import pandas as pd
@@ -10,30 +12,58 @@ import utils.helpers as hp
 from utils.helpers import timer
 import model.queries as qrs
 from utils.parquet import Parquet
+from model.AlarmIndex import AlarmIndex
+import utils.snapshot as snapshot
 import dash_bootstrap_components as dbc
 
 import urllib3
 urllib3.disable_warnings()
 
+# keeps the created_at high-water mark of the stored alarms and the next free id per event
+ALARMS_STATE = 'alarms_state.json'
+# alarm counts per (site, event, hour) of the stored 30 days, see Alarms.buildCube
+ALARMS_CUBE = 'alarmsCube.parquet'
+CUBE_BUCKET = 'h'
+
 class Alarms(object):
+  # (state file of the stored alarms, AlarmIndex of their pivot frames), see storedIndex
+  index = (None, None)
+  indexLock = threading.Lock()
+
+  # One row per value of the list column. The rows keep their index and, as with
+  # stack(), the missing values are dropped while the rows with no values are kept
+  @staticmethod
+  def explodeList(df, col, newName):
+      s = df[col].explode().dropna()
+      s.name = newName
+      return s
+
 
   @staticmethod
   def list2rows(df):
-      s = df.apply(lambda x: pd.Series(x['tag']), axis=1).stack().reset_index(level=1, drop=True)
-      s.name = 'tag'
+      s = Alarms.explodeList(df, 'tag', 'tag')
       df = df.drop('tag', axis=1).join(s)
       return df
   
 
-  def unpackAlarms(self, alarmsData):
+  # alarmsData holds one frame per event, as built by qrs.alarmFrames.
+  # firstIds sets the id of the first alarm for each event, so that
+  # the ids stay unique when new alarms are appended to the stored ones
+  def unpackAlarms(self, alarmsData, firstIds=None):
     frames, pivotFrames = {}, {}
+    firstIds = firstIds or {}
     
     try:
       for event, alarms in alarmsData.items():
         if len(alarms)>0:
-          df = pd.DataFrame(alarms)
+          df = alarms.reset_index(drop=True)
 
+          df.index = df.index + firstIds.get(event, 0)
           df['id'] = df.index
+          # the dates are parsed once here and kept as datetimes until they get displayed
+          for col in ['to', 'from']:
+            if col in df.columns:
+              df[col] = pd.to_datetime(df[col], utc=True, format='mixed')
           frames[event] = df
 
           if event == 'destination cannot be reached from multiple':
@@ -98,60 +128,44 @@ class Alarms(object):
 
   @staticmethod
   def one2manyUnfold(odf, fld, fldNewName, listSites, listedNewName):
-      s = odf.apply(lambda x: pd.Series(x[listSites]), axis=1).stack(
-      ).reset_index(level=1, drop=True)
-      s.name = listedNewName
+      s = Alarms.explodeList(odf, listSites, listedNewName)
       odf = odf.join(s)
       odf[fldNewName] = odf[fld]
       return odf
 
 
+  # Each alarm becomes one row per site in dest_sites (site -> dest_site) and one per site
+  # in src_sites (src_site -> site). The values of the parallel lists (dest_loss/dest_change,
+  # src_loss/src_change) are unfolded together with the sites.
+  # The rows are ordered by alarm, the destinations before the sources
   @staticmethod
   def oneInBothWaysUnfold(odf):
-    data = []
-
-    for r in odf.to_dict('records'):
-      for i, dest_site in enumerate(r['dest_sites']):
-        rec = {
-          'from': r['from'],
-          'to': r['to'],
-          'dest_site': dest_site,
-          'src_site': r['site'],
-          'id': r['id'],
-          'tag': r['tag'][0]
-        }
-        if 'dest_loss' in r.keys():
-          rec['dest_loss'] = r['dest_loss'][i]
-        elif 'dest_change' in r.keys():
-          rec['dest_change'] = r['dest_change'][i]
-
-        if 'ipv6' in r.keys():
-          rec['ipv6'] = r['ipv6']
-          
-        data.append(rec)
-
-      for i, src_site in enumerate(r['src_sites']):
-        rec = {
-          'from': r['from'],
-          'to': r['to'],
-          'src_site': src_site,
-          'dest_site': r['site'],
-          'id': r['id'],
-          'tag': r['tag'][0]
-        }
-        if 'src_loss' in r.keys():
-          rec['src_loss'] = r['src_loss'][i]
-        elif 'src_change' in r.keys():
-          rec['src_change'] = r['src_change'][i]
-
-        if 'ipv6' in r.keys():
-          rec['ipv6'] = r['ipv6']
-
-        data.append(rec)
-
-    df = pd.DataFrame(data)
-
-    return df
+    directions = [('dest', 'dest_site', 'src_site'), ('src', 'src_site', 'dest_site')]
+    odf = odf.assign(_row=np.arange(len(odf)))
+    parts = []
+
+    for part, (prefix, listed, fixed) in enumerate(directions):
+      sites = f'{prefix}_sites'
+      values = [c for c in [f'{prefix}_loss', f'{prefix}_change'] if c in odf.columns][:1]
+      df = odf[odf[sites].str.len() > 0]
+      cols = {'from': df['from'], 'to': df['to'],
+              listed: df[sites], fixed: df['site'],
+              'id': df['id'], 'tag': df['tag'].str[0]}
+      for c in values:
+        cols[c] = df[c]
+      if 'ipv6' in odf.columns:
+        cols['ipv6'] = df['ipv6']
+      cols['_row'], cols['_part'] = df['_row'], part
+      parts.append(pd.DataFrame(cols).explode([listed] + values))
+
+    df = pd.concat(parts).sort_values(['_row', '_part'], kind='stable')
+    if len(df) == 0:
+      return pd.DataFrame()
+    # the columns follow the first unfolded row, as when building the frame from records
+    first = parts[df['_part'].iloc[0]].columns
+    columns = list(first) + [c for c in parts[1 - df['_part'].iloc[0]].columns if c not in first]
+    columns = [c for c in columns if c not in ['_row', '_part']]
+    return df[columns].reset_index(drop=True).infer_objects()
 
 
   def getAllAlarms(self, dateFrom, dateTo):
@@ -161,45 +175,78 @@ class Alarms(object):
     return [frames, pivotFrames]
 
 
+  # Get only the alarms created after the watermark. Yields (frames, pivotFrames, watermark, {_id: created_at})
+  # for each chunk of the scan, the ids continue from one chunk to the next.
+  # The alarms in seen ({_id: created_at}) are already stored and are skipped.
+  # A failed query raises, so that nothing gets stored
+  def getNewAlarms(self, createdAfter, firstIds=None, seen=None):
+    nextIds = dict(firstIds or {})
+    for data, watermark, ids in qrs.queryNewAlarms(createdAfter, seen):
+      if 'indexing' in data.keys(): del data['indexing']
+      frames, pivotFrames = self.unpackAlarms(data, nextIds)
+      for event, df in frames.items():
+        nextIds[event] = int(df.index.max()) + 1
+      yield frames, pivotFrames, watermark, ids
+
+
+  # The state is kept in the snapshot generation together with the alarms it describes,
+  # location is the folder of that generation
+  @staticmethod
+  def readState(location):
+    filename = os.path.join(location, ALARMS_STATE)
+    try:
+      with open(filename) as f:
+        return json.load(f)
+    except FileNotFoundError:
+      return None
+    except Exception as e:
+      print(f'Cannot read {filename}:', e)
+      return None
+
+
+  @staticmethod
+  def writeState(state, location):
+    filename = os.path.join(location, ALARMS_STATE)
+    tmp = f'{filename}.tmp'
+    with open(tmp, 'w') as f:
+      json.dump(state, f)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(tmp, filename)
+
+
   # Check the requested period and either read the data
-  # from the local files or read from ES
-  def loadData(self, dateFrom, dateTo):
+  # from the local files or read from ES.
+  # By default the files come from the snapshot generation pinned by the request
+  def loadData(self, dateFrom, dateTo, location=None):
     print(f"loadData for {dateFrom}, {dateTo}")
     print('+++++++++++++++++++++')
     print()
-    current_time = time.time()
     pq = Parquet()
-    folder = glob.glob("parquet/frames/*")
+    location = location or snapshot.resolve('parquet/')
+    # each event is stored in a folder with one file per day
+    folder = [f for f in glob.glob(f"{location}frames/*") if os.path.isdir(f)]
     isTooOld = False
     frames, pivotFrames = {}, {}
     try:
       if folder:
-        for f in folder:
-            event = os.path.basename(f)
-            # remove the extension (.parquet)
-            event = os.path.splitext(event)[0]
-            event = self.eventUF(event)
-
-            df = pq.readFile(f)
-            df['to'] = pd.to_datetime(df['to'], utc=True)
-            modification_time = os.path.getmtime(f)
-
-            # Calculate the time difference in seconds
-            time_difference = current_time - modification_time
-            time_difference_hours = time_difference / (60 * 60)
-
-            # Check if the file was modified more than 1 hour ago
-            if time_difference_hours <  1:
-              # print('>>>>>>>', df['to'].min(), df['to'].max() , dateFrom, dateTo)
-              # print("The file was modified within the last hour.")
-              frames[event] = df[(df['to']>=dateFrom) & (df['to'] <= dateTo)]
-              pdf = pq.readFile(f"parquet/pivot/{os.path.basename(f)}")
+        if not self.isFresh(location):
+          print("\n\n The alarms were updated more than 1 hour ago.")
+          isTooOld = True
+        else:
+          for f in folder:
+            event = self.eventUF(os.path.basename(f))
+
+            # only the day files within the period are read
+            df = pq.readPartitions(f, nativeDates=True, dateFrom=dateFrom, dateTo=dateTo)
+            if len(df) == 0:
+              continue
+            frames[event] = df[(df['to']>=dateFrom) & (df['to'] <= dateTo)]
+            pdf = pq.readPartitions(f"{location}pivot/{os.path.basename(f)}", nativeDates=True,
+                                    dateFrom=dateFrom, dateTo=dateTo)
+            if len(pdf) > 0:
               pdf = pdf[(pdf['to'] >= dateFrom) & (pdf['to'] <= dateTo)]
-              pivotFrames[event] = pdf
-
-            else:
-              print("\n\n The file was modified more than 1 hour ago.", f)
-              isTooOld = True
+            pivotFrames[event] = pdf
       
       
       if len(folder)==0 or isTooOld == True:
@@ -212,6 +259,71 @@ class Alarms(object):
     return frames, pivotFrames
 
 
+  # the alarms are appended incrementally, so the time of the last refresh
+  # is kept by the state file and not by the modification time of each file
+  @staticmethod
+  def isFresh(location, maxAge=60*60):
+    stateFile = os.path.join(location, ALARMS_STATE)
+    return os.path.exists(stateFile) and time.time() - os.path.getmtime(stateFile) < maxAge
+
+
+  # Counts the alarms per site (the upper-cased tag), event and time bucket in a single groupby:
+  #   cnt  - the number of alarms, for 'ASN path anomalies per site' the number of anomalous paths
+  #   rows - the number of pivot rows
+  # The sites are the pivot tags, as counted by the status of the home page, so the rows whose
+  # tag is not a single site are left out as they were there
+  # An alarm has one "to", so it falls in one bucket and the counts of the buckets can be summed
+  @staticmethod
+  def buildCube(pivotFrames, freq=CUBE_BUCKET):
+    parts = []
+    for event, df in pivotFrames.items():
+      if len(df) == 0 or 'tag' not in df.columns:
+        continue
+      part = pd.DataFrame({'site': df['tag'].str.upper(),
+                           'event': event,
+                           'bucket': pd.to_datetime(df['to'], utc=True).dt.floor(freq),
+                           'id': df['id'],
+                           'paths': df['total_paths_anomalies'] if 'total_paths_anomalies' in df.columns else 0})
+      parts.append(part[part['site'].notna() & (part['site'] != '')])
+
+    if not parts:
+      return pd.DataFrame({'site': pd.Series(dtype=str), 'event': pd.Series(dtype=str),
+                           'bucket': pd.Series(dtype='datetime64[ns, UTC]'),
+                           'cnt': pd.Series(dtype=int), 'rows': pd.Series(dtype=int)})
+
+    cube = pd.concat(parts, ignore_index=True).groupby(['site', 'event', 'bucket']).agg(
+              rows=('id', 'count'), alarms=('id', 'nunique'), paths=('paths', 'sum')).reset_index()
+    cube['cnt'] = np.where(cube['event'] == 'ASN path anomalies per site', cube['paths'], cube['alarms'])
+    cube['bucket'] = cube['bucket'].astype('datetime64[ns, UTC]')
+    return cube[['site', 'event', 'bucket', 'cnt', 'rows']]
+
+
+  # The buckets between dateFrom and dateTo. The period is matched with the resolution
+  # of the buckets, i.e. the bucket starting at dateTo is included as a whole
+  @staticmethod
+  def sliceCube(cube, dateFrom=None, dateTo=None, freq=CUBE_BUCKET):
+    if dateFrom is not None:
+      cube = cube[cube['bucket'] >= pd.to_datetime(dateFrom, utc=True).floor(freq)]
+    if dateTo is not None:
+      cube = cube[cube['bucket'] <= pd.to_datetime(dateTo, utc=True)]
+    return cube
+
+
+  # Returns the cube stored with the alarms, sliced to the given period.
+  # When the stored alarms are not fresh, loadData queries ES instead,
+  # so the cube is built from the pivotFrames it returned
+  def loadCube(self, dateFrom, dateTo, pivotFrames=None, location=None):
+    location = location or snapshot.resolve('parquet/')
+    cube = None
+    if self.isFresh(location):
+      cube = Parquet().readFile(os.path.join(location, ALARMS_CUBE), nativeDates=True)
+    if not isinstance(cube, pd.DataFrame) or 'bucket' not in cube.columns:
+      if pivotFrames is None:
+        pivotFrames = self.loadData(dateFrom, dateTo, location)[1]
+      cube = self.buildCube(pivotFrames)
+    return self.sliceCube(cube, dateFrom, dateTo)
+
+
   @staticmethod
   def formatOtherAlarms(otherAlarms):
     if not otherAlarms:
@@ -229,38 +341,44 @@ class Alarms(object):
     # for a given alarm, check if there were additional alarms
     # 24h prior and 24h after the current event
     dateFrom, dateTo = hp.getPriorNhPeriod(alarmEnd)
-    # frames, pivotFrames = self.loadData(dateFrom, dateTo)
     print('getOtherAlarms')
-    
-    # print(dateFrom, dateTo, currEvent, alarmEnd, '# alarms:', [len(d) for d in pivotFrames], site, src_site, dest_site)
 
+    try:
+      # the stored alarms are indexed once per generation,
+      # otherwise pivotFrames (by default those of the period) come from ES and only they are indexed
+      location = snapshot.resolve('parquet/')
+      index = self.storedIndex(location) if self.isFresh(location) else None
+      if index is None:
+        if pivotFrames is None:
+          pivotFrames = self.loadData(dateFrom, dateTo)[1]
+        index = AlarmIndex(pivotFrames)
+      return index.otherAlarms(currEvent, dateFrom, dateTo, site, src_site, dest_site)
+    except Exception as e:
+      print(e, traceback.format_exc())
+      return {}
 
-    alarmsListed = {}
-
-    for event, pdf in pivotFrames.items():
-      if not event == currEvent:
-        try:
-          subdf = pdf[(pdf['to'] >= dateFrom) & (pdf['to'] <= dateTo)]
-
-          if src_site is not None and dest_site is not None and 'src_site' in pdf.columns and 'dest_site' in pdf.columns:
-            src_site, dest_site = src_site.upper(), dest_site.upper()
-            if len(subdf[(subdf['src_site'] == src_site) & (subdf['dest_site'] == dest_site)]) > 0:
-                subdf = subdf[(subdf['src_site'] == src_site) & (subdf['dest_site'] == dest_site)]
-                alarmsListed[event] = len(subdf['id'].unique())
-
-          elif site is not None:
-            site = site.upper()
-            if len(subdf[subdf['tag'] == site]) > 0:
-              subdf = subdf[((subdf['tag'] == site))]
 
-              if len(subdf) > 0:
-                  alarmsListed[event] = len(subdf['id'].unique())
+  # The index of all stored pivot alarms. The state file is replaced each time the alarms
+  # get updated, so the generations published by the other jobs share the same index
+  def storedIndex(self, location):
+    st = os.stat(os.path.join(location, ALARMS_STATE))
+    with Alarms.indexLock:
+      key = (st.st_dev, st.st_ino, st.st_mtime_ns)
+      if Alarms.index[0] != key:
+        pq = Parquet()
+        pivotFrames = {}
+        for f in glob.glob(f"{location}pivot/*"):
+          if os.path.isdir(f):
+            pivotFrames[self.eventUF(os.path.basename(f))] = pq.readPartitions(f, nativeDates=True)
+        Alarms.index = (key, AlarmIndex(pivotFrames))
+      return Alarms.index[1]
 
-        except Exception as e:
-            print(f'Issue with {event}')
-            print(e, traceback.format_exc())
 
-    return alarmsListed
+  # Builds the index of a new generation before the requests need it
+  def indexGeneration(self, generation):
+    location = generation + os.sep
+    if self.isFresh(location):
+      self.storedIndex(location)
 
 
   @staticmethod
@@ -315,6 +433,14 @@ class Alarms(object):
       return df[existing_columns + remaining_columns]
 
 
+  # The alarms keep the dates as datetimes, they are turned into strings only for display
+  @staticmethod
+  def formatDates(df):
+    for col in df.select_dtypes(include=['datetime', 'datetimetz']).columns:
+      df[col] = df[col].dt.strftime(hp.DATE_FORMAT)
+    return df
+
+
   # Format, hide or edit anything displayed in the datatables
   def formatDfValues(self, df, event, generate_button=False, site_report=False):
     try:
@@ -322,6 +448,7 @@ class Alarms(object):
                 'bandwidth decreased from/to multiple sites': ''}
 
         df = self.replaceCol('tag', df)
+        df = self.formatDates(df)
 
         if ('as_source_to' and 'as_destination_from' in df.columns) and ('sites' not in df.columns):
           
@@ -440,7 +567,7 @@ class Alarms(object):
   @staticmethod
   def createAlarmURL(df, event, site_report=False):
       def generate_url(row, event, page, site_report):
-          host_url = request.host_url
+          # the site report buttons have no URL, they are also built outside of a request (see SiteReports)
           if site_report:
               if 'ASN path anomalies' in event:
                   if event == 'ASN path anomalies per site':
@@ -475,6 +602,7 @@ class Alarms(object):
                   return '-'
 
           else:
+              host_url = request.host_url
               if 'ASN path anomalies' in event:
                   if event == 'ASN path anomalies per site':
                       details = f'site={row['site']}&date={row['to']}&id={row['alarm_id']}' if row['site'] and row['alarm_id'] else '-'
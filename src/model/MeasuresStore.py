@@ -0,0 +1,95 @@
+import os
+import threading
+
+import pandas as pd
+
+from utils.parquet import Parquet
+import utils.snapshot as snapshot
+
+# the averages of the last 24h, written by ParquetUpdater.cacheIndexData
+MEASURES_FILE = 'raw/measures.parquet'
+MEASURES_COLUMNS = ['src', 'dest', 'src_site', 'dest_site', 'idx', 'value', 'from', 'to', 'dt', 'unit']
+# the unit of the values of each index, after prepare()
+UNITS = {
+    'ps_packetloss': 'packet loss',
+    'ps_throughput': 'MBps',
+    'ps_owd': 'ms'
+}
+
+
+# The measurements of the sites, partitioned by the source/destination IP and the index:
+#   partition('src', ip, idx) - the rows of the IP as source of the index, the most recent first
+#   slices(ips)               - the partitions of the IPs of a site in both directions, kept per site
+# The rows of a site are then read from its own partitions instead of filtering the whole table.
+# The store is built once per measures file, see load()
+class MeasuresStore(object):
+    # (identity of the measures file, its MeasuresStore)
+    current = (None, None)
+    lock = threading.Lock()
+
+    def __init__(self, measures):
+        measures = measures.copy()
+        for col in MEASURES_COLUMNS:
+            if col not in measures.columns:
+                measures[col] = None
+        # the files written before the values were converted at ingest
+        if measures['unit'].isnull().all() and len(measures):
+            measures = MeasuresStore.prepare(measures)
+        self.measures = measures.sort_values('from', ascending=False, kind='stable').reset_index(drop=True)
+        self.empty = self.measures.iloc[:0]
+
+        self.partitions = {direction: self.measures.groupby([direction, 'idx'], sort=False).indices
+                           for direction in ['src', 'dest']}
+        self.sites = {}
+        self.sitesLock = threading.Lock()
+
+    # Adds the date of each row (dt) and the unit of its value, with the throughput converted from bits to MB.
+    # Called once at ingest, before the measures are written
+    @staticmethod
+    def prepare(measures):
+        measures['dt'] = pd.to_datetime(measures['from'], utc=True, format='mixed')
+        measures['value'] = measures['value'].where(measures['idx']!='ps_throughput', (measures['value']/1e+6).round(2))
+        measures['unit'] = measures['idx'].map(UNITS)
+        return measures
+
+    def partition(self, direction, ip, idx):
+        positions = self.partitions[direction].get((ip, idx))
+        return self.measures.take(positions) if positions is not None else self.empty
+
+    # {(direction, ip, idx): rows} of the given IPs, e.g. SiteDirectory.ips(site).
+    # Built on the first call for the IPs and kept along with the store
+    def slices(self, ips):
+        key = tuple(ips)
+        with self.sitesLock:
+            slices = self.sites.get(key)
+        if slices is None:
+            slices = {(direction, ip, idx): self.partition(direction, ip, idx)
+                      for direction in ['src', 'dest'] for ip in ips for idx in UNITS}
+            with self.sitesLock:
+                self.sites[key] = slices
+        return slices
+
+    # The store of the measures of the location (by default of the pinned generation).
+    # The file is replaced by each run of cacheIndexData, so the generations which share it share the store
+    @staticmethod
+    def load(location='parquet/'):
+        filename = snapshot.resolve(f'{location}{MEASURES_FILE}')
+        try:
+            st = os.stat(filename)
+            key = (st.st_dev, st.st_ino, st.st_mtime_ns)
+        except FileNotFoundError:
+            print(f"{filename} not found.")
+            return MeasuresStore(pd.DataFrame(columns=MEASURES_COLUMNS))
+
+        with MeasuresStore.lock:
+            if MeasuresStore.current[0] != key:
+                measures = Parquet().readFile(filename, cache=False, nativeDates=True)
+                if measures is None:
+                    measures = pd.DataFrame(columns=MEASURES_COLUMNS)
+                MeasuresStore.current = (key, MeasuresStore(measures))
+            return MeasuresStore.current[1]
+
+    # Builds the store of a new generation before the requests need it, used as a snapshot.watch() listener
+    @staticmethod
+    def loadGeneration(generation):
+        MeasuresStore.load(generation + os.sep)
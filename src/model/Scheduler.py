@@ -0,0 +1,165 @@
+import json
+import os
+import random
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+# the jobs share one pool, so at most that many of them run at the same time
+SCHEDULER_WORKERS = 2
+# how often the dispatcher checks for due jobs
+TICK = 5  # seconds
+# each run is delayed by up to JITTER * interval, so the jobs with equal intervals spread out
+JITTER = 0.05
+# the first retry after a failure, doubled on each consecutive failure and capped at the interval
+RETRY_DELAY = 60  # seconds
+
+
+class Job(object):
+
+    def __init__(self, name, function, interval, after=()):
+        self.name = name
+        self.function = function
+        self.interval = interval
+        self.after = list(after)
+        self.next_call = time.time() + interval
+        self.running = False
+        self.runs = 0
+        self.skipped = 0
+        self.failures = 0
+        self.last_start = None
+        self.last_duration = None
+        self.last_success = None
+        self.last_error = None
+
+    def metrics(self):
+        return {'interval': self.interval,
+                'after': self.after,
+                'running': self.running,
+                'runs': self.runs,
+                'skipped': self.skipped,
+                'consecutive_failures': self.failures,
+                'next_call': round(self.next_call, 3),
+                'last_start': self.last_start,
+                'last_duration': self.last_duration,
+                'last_success': self.last_success,
+                'last_error': self.last_error}
+
+
+# Runs the registered jobs periodically on a single pool.
+# - a job is not started again while its previous run is still going, that run is skipped
+# - a job waits while any of the jobs listed in "after" is running or due,
+#   e.g. the alarms are grouped with the metadata of the same round
+# - after a failure the job is retried with an exponential backoff
+# - metrics() returns the state and the last duration/success of each job,
+#   they are also written to metricsFile after each run when it is set
+class Scheduler(object):
+
+    def __init__(self, workers=SCHEDULER_WORKERS, metricsFile=None):
+        self.metricsFile = metricsFile
+        self.metricsLock = threading.Lock()
+        self.jobs = {}
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='scheduler')
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def add(self, interval, function, after=(), name=None):
+        name = name or function.__name__
+        self.jobs[name] = Job(name, function, interval, after)
+        return self.jobs[name]
+
+    def start(self):
+        self.thread = threading.Thread(target=self._loop, name='scheduler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+        self.pool.shutdown(wait=False)
+
+    # Runs the job in the calling thread, e.g. for the initial update
+    def run(self, name):
+        job = self.jobs[name]
+        with self.lock:
+            if job.running:
+                job.skipped += 1
+                print(f"{name} is already running, skipping")
+                return False
+            job.running = True
+        return self._execute(job)
+
+    def metrics(self):
+        with self.lock:
+            return {name: job.metrics() for name, job in self.jobs.items()}
+
+    def dumpMetrics(self):
+        if self.metricsFile is None:
+            return
+        try:
+            metrics = self.metrics()
+            with self.metricsLock:
+                tmp = f'{self.metricsFile}.tmp'
+                with open(tmp, 'w') as f:
+                    json.dump(metrics, f)
+                os.replace(tmp, self.metricsFile)
+        except Exception as e:
+            print(f"Cannot write {self.metricsFile}:", e)
+
+    def _loop(self):
+        while not self.stopped.is_set():
+            now = time.time()
+            with self.lock:
+                for job in self.jobs.values():
+                    if job.next_call > now:
+                        continue
+                    if job.running:
+                        job.skipped += 1
+                        job.next_call = now + self._delay(job.interval)
+                        print(f"{job.name} is still running, skipping this run")
+                        continue
+                    deps = [self.jobs[d] for d in job.after if d in self.jobs]
+                    if any(d.running or d.next_call <= now for d in deps):
+                        continue
+                    job.running = True
+                    job.next_call = now + self._delay(job.interval)
+                    self.pool.submit(self._execute, job)
+            self.wakeup.wait(TICK)
+            self.wakeup.clear()
+
+    @staticmethod
+    def _delay(interval):
+        return interval + random.uniform(0, JITTER * interval)
+
+    def _execute(self, job):
+        start = time.time()
+        job.last_start = round(start, 3)
+        error = None
+        try:
+            job.function()
+        except Exception as e:
+            error = repr(e)
+            print(f"Job {job.name} failed")
+            print(traceback.format_exc())
+
+        with self.lock:
+            end = time.time()
+            job.running = False
+            job.runs += 1
+            job.last_duration = round(end - start, 3)
+            if error is None:
+                job.failures = 0
+                job.last_success = round(end, 3)
+                job.last_error = None
+            else:
+                job.failures += 1
+                job.last_error = error
+                backoff = min(job.interval, RETRY_DELAY * 2**(job.failures - 1))
+                job.next_call = end + backoff
+                print(f"Retrying {job.name} in {backoff} secs")
+        self.dumpMetrics()
+        # the jobs waiting for this one can start
+        self.wakeup.set()
+        return error is None
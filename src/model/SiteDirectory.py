@@ -0,0 +1,100 @@
+import os
+import threading
+
+import pandas as pd
+
+from utils.parquet import Parquet
+import utils.snapshot as snapshot
+
+# the metadata of the hosts, written by ParquetUpdater.storeMetaData
+META_FILE = 'raw/metaDf.parquet'
+META_COLUMNS = ['host', 'ip', 'site', 'netsite', 'ipv6', 'lat', 'lon', 'country']
+
+
+# Lookups over the stored metadata of the hosts, instead of filtering metaDf on each call:
+#   ips(site)        - the IPs of the hosts whose site or netsite is the given one, in the order of the rows
+#   ipVariants(site) - the same IPs upper-cased and lower-cased, as they are searched in the measurements
+#   siteOf(ip)       - the site of an IP, in any case
+#   hostIps(host)    - the IPs of a host
+#   hosts(site)      - (host, 'ipv6'/'ipv4') of the hosts of the site
+# along with the most common location of each site and the country of each location.
+# The directory is built once per metaDf file, see load()
+class SiteDirectory(object):
+    # (identity of the metaDf file, its SiteDirectory)
+    current = (None, None)
+    lock = threading.Lock()
+
+    def __init__(self, metaDf):
+        metaDf = metaDf.copy()
+        for col in META_COLUMNS:
+            if col not in metaDf.columns:
+                metaDf[col] = None
+        self.metaDf = metaDf
+
+        self.siteIps, self.ipSite, self.hostIpList, self.siteHosts = {}, {}, {}, {}
+        for host, ip, site, netsite, ipv6 in zip(metaDf['host'], metaDf['ip'], metaDf['site'],
+                                                  metaDf['netsite'], metaDf['ipv6']):
+            # a row is listed once when its site and netsite are the same
+            for key in {site, netsite}:
+                if isinstance(key, str):
+                    self.siteIps.setdefault(key, []).append(ip)
+            if isinstance(ip, str) and isinstance(site, str):
+                self.ipSite.setdefault(ip.lower(), site)
+            if isinstance(host, str) and ip not in self.hostIpList.setdefault(host, []):
+                self.hostIpList[host].append(ip)
+            if isinstance(site, str):
+                self.siteHosts.setdefault(site, []).append((host, 'ipv6' if ipv6 else 'ipv4'))
+
+        self.variants = {key: [ip.upper() for ip in ips if isinstance(ip, str)] + [ip.lower() for ip in ips if isinstance(ip, str)]
+                         for key, ips in self.siteIps.items()}
+        self.countries = metaDf[['lat', 'lon', 'country']].drop_duplicates()
+        self.siteCountry = metaDf.dropna(subset=['site']).drop_duplicates('site').set_index('site')['country'].to_dict()
+        self.locations = self.mostCommonLocations(metaDf)
+
+    # The most common (lat, lon) of each site
+    @staticmethod
+    def mostCommonLocations(metaDf):
+        nodes = metaDf[~(metaDf['site'].isnull()) & (metaDf['site'] != '')\
+               & (metaDf['lat'] != '') & (metaDf['lat'].isnull()==False)].drop_duplicates()
+        lat_lon_count = nodes.groupby(['site', 'lat', 'lon']).size().reset_index(name='count')
+        return lat_lon_count.loc[lat_lon_count.groupby('site')['count'].idxmax()][['site', 'lat', 'lon']]
+
+    def ips(self, site):
+        return list(self.siteIps.get(site, []))
+
+    def ipVariants(self, site):
+        return list(self.variants.get(site, []))
+
+    def siteOf(self, ip):
+        return self.ipSite.get(ip.lower()) if isinstance(ip, str) else None
+
+    def hostIps(self, host):
+        return list(self.hostIpList.get(host, []))
+
+    def hosts(self, site):
+        return list(self.siteHosts.get(site, []))
+
+    def country(self, site):
+        return self.siteCountry.get(site)
+
+    # The directory of the metaDf of the location (by default of the pinned generation).
+    # The file is replaced by each refresh of the metadata, so the generations which share it share the directory
+    @staticmethod
+    def load(location='parquet/'):
+        filename = snapshot.resolve(f'{location}{META_FILE}')
+        try:
+            st = os.stat(filename)
+            key = (st.st_dev, st.st_ino, st.st_mtime_ns)
+        except FileNotFoundError:
+            print(f"{filename} not found.")
+            return SiteDirectory(pd.DataFrame(columns=META_COLUMNS))
+
+        with SiteDirectory.lock:
+            if SiteDirectory.current[0] != key:
+                SiteDirectory.current = (key, SiteDirectory(Parquet().readFile(filename)))
+            return SiteDirectory.current[1]
+
+    # Builds the directory of a new generation before the requests need it, used as a snapshot.watch() listener
+    @staticmethod
+    def loadGeneration(generation):
+        SiteDirectory.load(generation + os.sep)
@@ -0,0 +1,51 @@
+import threading
+import time
+import traceback
+
+import model.queries as qrs
+
+# how long the metadata of a site is served before it is queried again
+SITE_METADATA_TTL = 60*60  # seconds
+
+
+# Process-wide cache of the ps_meta metadata of the sites: the latest document of each host,
+# the most recent first, as returned by qrs.latestHostsMetadata (None when the site has none).
+# A missing or expired site is queried on its own, refresh() replaces all of them with a single request.
+# The failed queries are not cached, so they are retried by the next call
+class SiteMetadata(object):
+
+    def __init__(self, ttl=SITE_METADATA_TTL):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, site):
+        with self.lock:
+            entry = self.entries.get(site)
+        if entry is not None and time.time() - entry[0] < self.ttl:
+            return entry[1]
+        try:
+            meta = qrs.latestHostsMetadata([{"match_phrase": {"netsite": site}}, qrs.metaPeriodFilter()])
+        except Exception as e:
+            print(f"Error fetching metadata: {str(e)}")
+            return None
+        with self.lock:
+            self.entries[site] = (time.time(), meta)
+        return meta
+
+    # Queries all the sites at once, e.g. by the updater before it builds the site reports.
+    # The given sites missing from the result are cached as having no metadata
+    def refresh(self, sites=()):
+        try:
+            meta = qrs.getSitesMetadata()
+        except Exception as e:
+            print(traceback.format_exc())
+            return False
+        now = time.time()
+        with self.lock:
+            self.entries = {site: (now, meta.get(site)) for site in set(sites) | set(meta)}
+        print(f"Metadata of {len(meta)} sites")
+        return True
+
+
+siteMetadata = SiteMetadata()
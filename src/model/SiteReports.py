@@ -0,0 +1,177 @@
+import json
+import os
+import shutil
+from datetime import datetime, timedelta
+from urllib.parse import quote
+
+import pandas as pd
+from dash import html
+from plotly.utils import PlotlyJSONEncoder
+
+import utils.helpers as hp
+import model.queries as qrs
+from model.Alarms import Alarms
+from model.SiteMetadata import siteMetadata
+from model.SiteDirectory import SiteDirectory
+from utils.parquet import Parquet
+import utils.snapshot as snapshot
+
+# one JSON bundle per site, written with each refresh of the alarms
+SITE_REPORTS = 'site_reports/'
+# the alarms which are not part of the site reports
+EXCLUDED_EVENTS = ['path changed between sites', 'path changed', 'ASN path anomalies']
+ALARM_COLUMNS = ['to', 'alarm group', 'alarm name', 'hosts', 'IP version', 'Details', 'cnt', 'Involved Site(s)']
+# the fields listing the other sites of an alarm, ordered by priority if multiple exist
+DEST_SITE_FIELDS = ['sites', 'cannotBeReachedFrom', 'to_dest_loss', 'from_src_loss', 'src_sites', 'dest_sites',
+                    'dest_netsite', 'dest_site', 'src_site', 'src_netsite']
+
+
+# Builds the data of the site report page for all sites at once: the alarms of the week,
+# the daily alarm counts of the status chart and the metadata of the site.
+# Usage:
+#   SiteReports().store(location, bundles) - by the updater, in the generation being built
+#   SiteReports().report(site)             - by the page, reads the bundle of the pinned generation only
+class SiteReports(object):
+
+    def __init__(self, location='parquet/'):
+        self.location = location
+        self.pq = Parquet()
+        self.alarms = Alarms()
+
+    def path(self, site, location=None):
+        return f"{location or self.location}{SITE_REPORTS}{quote(site, safe='')}.json"
+
+    # The week covered by the reports, the same for all the bundles of a run
+    @staticmethod
+    def period():
+        now = datetime.now()
+        fromDate = (now - timedelta(days=6)).replace(minute=0, second=0, microsecond=0)
+        # as in queries we extract based on created_at, to get all the alarms we need to get up to now
+        # and after that filter the data by 'to' to get a week of data
+        toDate = now.replace(minute=0, second=0, microsecond=0)
+        start_date, end_date = hp.defaultTimeRange(days=7)
+        return {'now': now.strftime('%Y-%m-%dT%H:%M:%S'),
+                'fromDate': fromDate.strftime('%Y-%m-%dT%H:%M:%S'),
+                'toDate': toDate.strftime('%Y-%m-%dT%H:%M:%S'),
+                'start_date': start_date,
+                'end_date': end_date}
+
+    # One row per alarm and site in its tag, with the columns of the alarms table of the page
+    def alarmsTable(self, frames):
+        subcategories = qrs.getSubcategories()
+        categories = dict(zip(subcategories['event'], subcategories['category']))
+        tables = []
+        for event, df in frames.items():
+            if event in EXCLUDED_EVENTS or len(df) == 0:
+                continue
+            df = df.reset_index(drop=True)
+            sites = df['tag'].explode().dropna()
+            df['to'] = pd.to_datetime(df['to'], errors='coerce').dt.normalize().dt.strftime('%Y-%m-%d')
+            df = self.alarms.formatDfValues(df, event, False, True)
+            if df is None:
+                continue
+
+            if 'host' in df.columns:
+                hosts = df['host']
+            elif 'hosts' in df.columns:
+                hosts = df['hosts'].apply(lambda x: html.Div([html.Div(item) for item in x.split('\n')]) if isinstance(x, str) else x)
+            else:
+                hosts = None
+            fields = [f for f in DEST_SITE_FIELDS if f in df.columns]
+            involved = [[html.Div(item) for value in values if isinstance(value, str) for item in value.split('\n')]
+                        for values in zip(*[df[f] for f in fields])] if fields else [[] for _ in range(len(df))]
+
+            table = pd.DataFrame({'to': df['to'],
+                                  'alarm group': categories.get(event, 'Other'),
+                                  'alarm name': event,
+                                  'hosts': hosts,
+                                  'IP version': df['IP version'] if 'IP version' in df.columns else None,
+                                  'Details': df['alarm_link'] if 'alarm_link' in df.columns else None,
+                                  'cnt': df['total_paths_anomalies'] if 'total_paths_anomalies' in df.columns else 1,
+                                  'Involved Site(s)': involved}, index=df.index)
+            table = table.loc[sites.index]
+            table.insert(0, 'site', sites.values)
+            tables.append(table)
+
+        if not tables:
+            return pd.DataFrame(columns=['site'] + ALARM_COLUMNS)
+        return pd.concat(tables, ignore_index=True)
+
+    # The number of alarms per site, day and event, as shown by the daily status chart.
+    # Counted from the alarms table, so that the chart and the table under it agree
+    @staticmethod
+    def dailyStatus(alarms):
+        return alarms.groupby(['site', 'to', 'alarm name'])['cnt'].sum().reset_index()
+
+    # The bundles of the given sites (by default all the known sites) from the data of the location
+    def build(self, location=None, sites=None):
+        location = location or snapshot.resolve(self.location)
+        period = self.period()
+        frames = self.alarms.loadData(period['start_date'], period['end_date'], location)[0]
+        alarms = self.alarmsTable(frames)
+        status = self.dailyStatus(alarms)
+
+        directory = SiteDirectory.load(location)
+        alarmCnt = self.pq.readFile(f'{location}alarmsGrouped.parquet')
+        alarmedSites = set(alarmCnt['site']) if isinstance(alarmCnt, pd.DataFrame) and 'site' in alarmCnt.columns else set()
+        if sites is None:
+            sites = set(directory.siteHosts) | alarmedSites | set(alarms['site'])
+            sites = sorted(s for s in sites if isinstance(s, str) and s)
+            # the metadata of all sites is fetched with one request
+            siteMetadata.refresh(sites)
+
+        alarmsBySite = {site: df for site, df in alarms.groupby('site', sort=False)}
+        statusBySite = {site: df for site, df in status.groupby('site', sort=False)}
+
+        bundles = {}
+        for site in sites:
+            siteAlarms = alarmsBySite.get(site, alarms.iloc[:0])
+            siteStatus = statusBySite.get(site, status.iloc[:0])
+            meta = siteMetadata.get(site)
+            bundles[site] = {'site': site,
+                             'found': meta is not None or site in alarmedSites,
+                             'period': period,
+                             'alarms': siteAlarms[ALARM_COLUMNS].to_dict('records'),
+                             'status': siteStatus[['to', 'alarm name', 'cnt']].to_dict('records'),
+                             'country': directory.country(site),
+                             'hosts': directory.hosts(site),
+                             'cpus': meta.iloc[0]['cpus'] if meta is not None else None,
+                             'cpu_cores': meta.iloc[0]['cpu_cores'] if meta is not None else None}
+        return bundles
+
+    # Writes the bundles of all sites (by default built from the location) to the generation being built,
+    # replacing those of the previous run
+    def store(self, location, bundles=None):
+        if bundles is None:
+            bundles = self.build(location)
+        folder = f'{location}{SITE_REPORTS}'
+        shutil.rmtree(folder, ignore_errors=True)
+        os.makedirs(folder)
+        for site, bundle in bundles.items():
+            with open(self.path(site, location), 'w') as f:
+                json.dump(bundle, f, cls=PlotlyJSONEncoder)
+        print(f"Site reports: {len(bundles)}")
+        return len(bundles)
+
+    def load(self, site):
+        try:
+            with open(snapshot.resolve(self.path(site))) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    # The stored bundle of the site. The bundles are only built by the updater, so a known site
+    # missing from the stored reports (e.g. before the first run) is reported as being prepared
+    def report(self, site):
+        if not site:
+            return {'site': site, 'found': False, 'preparing': False}
+        bundle = self.load(site)
+        if bundle is None:
+            return {'site': site, 'found': False, 'preparing': self.isKnown(site)}
+        return bundle
+
+    # The sites (or netsites) of the stored metadata of the hosts
+    @staticmethod
+    def isKnown(site):
+        directory = SiteDirectory.load()
+        return site in directory.siteIps or site in directory.siteHosts
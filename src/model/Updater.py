@@ -1,12 +1,21 @@
 import gc
+import glob
 import os
+import shutil
 import os.path
 import time
 import threading
 import traceback
 
 from utils.parquet import Parquet
-from model.Alarms import Alarms
+from utils.snapshot import Snapshot
+from utils.httpcache import HttpCache
+import utils.snapshot as snapshot
+from model.Alarms import Alarms, ALARMS_CUBE
+from model.SiteReports import SiteReports, SITE_REPORTS
+from model.SiteDirectory import SiteDirectory
+from model.MeasuresStore import MeasuresStore, MEASURES_FILE
+from model.Scheduler import Scheduler
 import utils.helpers as hp
 from utils.helpers import timer
 import model.queries as qrs
@@ -19,162 +28,270 @@ from ml.create_packet_loss_dataset import createPcktDataset
 from ml.packet_loss_one_month_onehot import one_month_data
 from ml.packet_loss_train_model import packet_loss_train_model
 import os
-import logging
-import requests
 import json
 from utils.hosts_audit import audit
 import asyncio
-from datetime import datetime, timedelta, timezone
-from pathlib import Path
+from datetime import datetime, timedelta
 
+CRIC_SERVICES = 'https://wlcg-cric.cern.ch/api/core/service/query/?json&state=ACTIVE&type=PerfSonar'
+CRIC_RCSITES = 'https://wlcg-cric.cern.ch/api/core/rcsite/query/list/?json'
+PSCONFIG = 'https://psconfig.aglt2.org/pub/config'
 CRIC_OPN_RCSITES = {"CERN-PROD":'CERN-PROD-LHCOPNE', "BNL-ATLAS":'BNL-ATLAS-LHCOPNE', "INFN-T1":'INFN-T1-LHCOPNE',
                     "USCMS-FNAL-WC1":'USCMS-FNAL-WC1-LHCOPNE', "FZK-LCG2":'FZK-LCG2-LHCOPNE', "IN2P3-CC":'IN2P3-CC-LHCOPNE', "RAL-LCG2":'RAL-LCG2-LHCOPN', 
                     "JINR-T1":'JINR-T1-LHCOPNE', "pic":'PIC-LHCOPNE', "SARA-MATRIX":'NLT1-SARA-LHCOPNE',
                     "TRIUMF-LCG2":'TRIUMF-LCG2-LHCOPNE', "NDGF-T1":'NDGF-T1-LHCOPNE', "KR-KISTI-GSDC-01":'KR-KISTI-GSDC-1-LHCOPNE',
                     "NCBJ-CIS":'NCBJ-LHCOPN'}
+# the job metrics written by the scheduler, they are read by app.py when the updater runs separately
+JOBS_METRICS = 'jobs.json'
+# the order in which the cache gets populated when it is not fresh at start,
+# the data needed by the home page comes first
+WARMUP_ORDER = ['storeMetaData', 'storeAlarms', 'storeSiteReports', 'cacheIndexData', 'storeASNPathChanged',
+                'validOPNTraceroutes', 'storeCRICData', 'psConfigDataAndAudit']
+# dataset: (job writing it, file checked for its presence)
+DATASETS = {'metadata': ('storeMetaData', 'raw/metaDf.parquet'),
+            'alarms': ('storeAlarms', 'alarmsGrouped.parquet'),
+            'site_reports': ('storeSiteReports', SITE_REPORTS),
+            'measures': ('cacheIndexData', MEASURES_FILE),
+            'asn_path_changes': ('storeASNPathChanged', 'asn_path_changes.parquet'),
+            'opn_traceroutes': ('validOPNTraceroutes', 'raw/traceroutes_OPN.parquet'),
+            'cric': ('storeCRICData', 'raw/CRICDataHosts.parquet'),
+            'psconfig_audit': ('psConfigDataAndAudit', 'audited_hosts.parquet')}
+
+
+# the datasets written to each generation, see recordDataset
+MANIFEST = 'manifest.json'
+# the datasets whose sources were found unchanged since they were built, see recordVerified.
+# Kept outside the generations, so that no generation is published for them
+VERIFIED = 'verified.json'
+
+
+def readManifest(location='parquet/'):
+    try:
+        with open(snapshot.resolve(f'{location}{MANIFEST}')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print(traceback.format_exc())
+        return {}
+
+
+# Status of each dataset:
+#   ready   - refreshed by this process or not due for a refresh
+#   stale   - the data of the previous snapshot is served while it gets refreshed
+#   warming - not available yet
+# metrics are the ones of Scheduler.metrics() and warming the jobs not yet run by the warm-up
+def readiness(location='parquet/', metrics=None, warming=()):
+    metrics = metrics or {}
+    status = {}
+    for dataset, (job, filename) in DATASETS.items():
+        exists = os.path.exists(snapshot.resolve(f'{location}{filename}'))
+        if metrics.get(job, {}).get('last_success') is not None or (exists and job not in warming):
+            status[dataset] = 'ready'
+        elif exists:
+            status[dataset] = 'stale'
+        else:
+            status[dataset] = 'warming'
+    return status
+
 @timer
 class ParquetUpdater(object):
     
-    def __init__(self, location='parquet/'):
+    # With background=True the constructor returns at once and the cache is populated
+    # by a separate thread, while the previous snapshot (if any) is served
+    def __init__(self, location='parquet/', background=True):
         self.pq = Parquet()
         self.alarms = Alarms()
+        self.http = HttpCache(f'{location}http-cache/')
         self.location = location
+        self.warming = set()
         required_folders = ['raw', 'frames', 'pivot', 'ml-datasets']
         self.createLocation(required_folders)
 
-        try:
-            if not self.__isDataFresh(required_folders):
-                print("Updating...")
-                self.storeMetaData()
-                self.cacheIndexData()
-                self.storeAlarms()
-                self.storeASNPathChanged()
-
-                # self.storeThroughputDataAndModel()
-                # self.storePacketLossDataAndModel()
-                
-                self.psConfigDataAndAudit()
-                self.storeCRICData()
-                self.validOPNTraceroutes()
-
-            # Set the schedulers
-            Scheduler(60*60*12, self.storeMetaData)
-            Scheduler(60*60, self.cacheIndexData)
-
-            Scheduler(60*30, self.storeAlarms)
-            Scheduler(60*60*12, self.storeASNPathChanged)
-            Scheduler(60*60*24, self.storeCRICData)
-            Scheduler(60*60*24, self.psConfigDataAndAudit)
-            Scheduler(60*60*2, self.validOPNTraceroutes)
-
-
-            # Scheduler(60*60*12, self.storeThroughputDataAndModel)
-            # Scheduler(60*60*12, self.storePacketLossDataAndModel)
-        except Exception as e:
-            print(traceback.format_exc())
+        # Set the schedulers
+        self.scheduler = Scheduler(metricsFile=f'{self.location}{JOBS_METRICS}')
+        self.scheduler.add(60*60*12, self.storeMetaData)
+        self.scheduler.add(60*60, self.cacheIndexData)
 
+        # groupAlarms uses the stored metadata
+        self.scheduler.add(60*30, self.storeAlarms, after=['storeMetaData'])
+        # the site report bundles are rebuilt after each refresh of the alarms
+        self.scheduler.add(60*30, self.storeSiteReports, after=['storeAlarms'])
+        self.scheduler.add(60*60*12, self.storeASNPathChanged)
+        self.scheduler.add(60*60*24, self.storeCRICData)
+        self.scheduler.add(60*60*24, self.psConfigDataAndAudit)
+        self.scheduler.add(60*60*2, self.validOPNTraceroutes)
 
-    # The following function is used to group alarms by site 
-    # taking into account the most recent 48 hours only
-    def groupAlarms(self, pivotFrames):
-        dateFrom, dateTo = hp.defaultTimeRange(days=2)
-        metaDf = self.pq.readFile('parquet/raw/metaDf.parquet')
-        # frames, pivotFrames = self.alarms.loadData(dateFrom, dateTo)
 
-        nodes = metaDf[~(metaDf['site'].isnull()) & (metaDf['site'] != '')\
-               & (metaDf['lat'] != '') & (metaDf['lat'].isnull()==False)].drop_duplicates()
-        lat_lon_count = nodes.groupby(['site', 'lat', 'lon']).size().reset_index(name='count')
-        # Find the most common lat-lon for each site
-        most_common_lat_lon = lat_lon_count.loc[lat_lon_count.groupby('site')['count'].idxmax()]
+        # self.scheduler.add(60*60*12, self.storeThroughputDataAndModel)
+        # self.scheduler.add(60*60*12, self.storePacketLossDataAndModel)
 
-        alarmCnt = []
-        
-        for site, lat, lon in most_common_lat_lon[['site', 'lat', 'lon']].values.tolist():
-            for e, df in pivotFrames.items():
-                # column "to" is closest to the time the alarms was generated, 
-                # thus we want to which approx. when the alarms was created,
-                # to be between dateFrom and dateTo
-                df['to'] = pd.to_datetime(df['to'], utc=True)
-                sdf = df[(df['tag'].str.upper() == site.upper()) & (df['to'] >= dateFrom) & (df['to'] <= dateTo)]
-                # print('e: ', e)
-                # if e == 'high delay from/to multiple sites':
-                #     print(sdf)
-                if len(sdf) > 0:
-                    # sdf['id'].unique() returns the number of unique alarms for the given site
-                    # those are the documents generated and stored in ES. They can be found in frames folder
-                    # While pivotFrames expands the alarms to the level of individual sites
-                    if e == 'ASN path anomalies per site':
-                        cnt =sum(sdf['total_paths_anomalies'].tolist())
-                    
-                    else:
-                        cnt = len(sdf['id'].unique())
-                    entry = {"event": e, "site": site, 'cnt':  cnt,
-                            "lat": lat, "lon": lon}
+        try:
+            # only the jobs of the datasets which are not fresh are run at start,
+            # the rest are due one interval after their last completion
+            stale = self.staleJobs()
+            if stale:
+                print("Updating...", stale)
+                self.warming = set(stale)
+                if background:
+                    threading.Thread(target=self.warmUp, name='warm-up', daemon=True).start()
                 else:
-                    entry = {"event": e, "site": site, 'cnt': 0,
-                            "lat": lat, "lon": lon}
-                alarmCnt.append(entry)
+                    self.warmUp()
+        except Exception as e:
+            print(traceback.format_exc())
 
-        print('Number of sites:', len(alarmCnt))
-        alarmsGrouped = pd.DataFrame(alarmCnt)
-        print('Number of site-alarms:', len(alarmsGrouped[alarmsGrouped['cnt']>0]))
+        self.scheduler.start()
 
-        self.pq.writeToFile(alarmsGrouped, f'{self.location}alarmsGrouped.parquet')
 
+    def warmUp(self):
+        for job in [j for j in WARMUP_ORDER if j in self.warming]:
+            self.scheduler.run(job)
+            self.warming.discard(job)
+        print("The cache is warmed up.")
 
-    def __isDataFresh(self, required_folders, freshness_threshold=1*60*60): # 1 hour
-        """
-        Check if the data in the specified location is fresh.
-        :param location: The directory to check.
-        :param freshness_threshold: The freshness threshold in seconds (default is 1 hour).
-        :return: True if the data is fresh, False otherwise.
-        """
-        current_time = time.time()
-        
-        for folder in required_folders:
-            folder_path = os.path.join(self.location, folder)
-            print(f"Checking folder: {folder_path}")
-            if not os.listdir(folder_path):
-                print(f"Folder {folder_path} is empty.")
-                return False
 
-        for root, dirs, files in os.walk(self.location):
-            for file in files:
-                file_path = os.path.join(root, file)
-                file_mod_time = os.path.getmtime(file_path)
-                file_age = current_time - file_mod_time
-                print(f"File: {file_path}, Age: {file_age} seconds")
-                if file_age > freshness_threshold:
-                    print(f"File {file_path} is older than the freshness threshold.")
-                    return False
+    def readiness(self):
+        return readiness(self.location, self.scheduler.metrics(), self.warming)
 
-        print("All files are fresh.")
-        return True
 
+    # The following function is used to group alarms by site 
+    # taking into account the most recent 48 hours only
+    # The status of each site for the last 2 days, sliced from the alarm cube.
+    # Each site gets a row per event, also when it had no alarms
+    def groupAlarms(self, cube, events, location):
+        dateFrom, dateTo = hp.defaultTimeRange(days=2)
+        # the most common lat-lon of each site
+        most_common_lat_lon = SiteDirectory.load(location).locations
+
+        # column "to" is closest to the time the alarms was generated, 
+        # thus we want to which approx. when the alarms was created,
+        # to be between dateFrom and dateTo
+        counts = self.alarms.sliceCube(cube, dateFrom, dateTo).groupby(['site', 'event'])['cnt'].sum().reset_index()
+        counts = counts.rename(columns={'site': 'key'})
+
+        alarmsGrouped = most_common_lat_lon[['site', 'lat', 'lon']].merge(pd.DataFrame({'event': events}), how='cross')
+        alarmsGrouped['key'] = alarmsGrouped['site'].str.upper()
+        alarmsGrouped = alarmsGrouped.merge(counts, on=['key', 'event'], how='left')
+        alarmsGrouped['cnt'] = alarmsGrouped['cnt'].fillna(0).astype(int)
+        alarmsGrouped = alarmsGrouped[['event', 'site', 'cnt', 'lat', 'lon']]
+
+        print('Number of sites:', len(alarmsGrouped))
+        print('Number of site-alarms:', len(alarmsGrouped[alarmsGrouped['cnt']>0]))
 
-    @timer
-    def queryData(self, idx, dateFrom, dateTo):
-        intv = int(hp.CalcMinutes4Period(dateFrom, dateTo)/30)
+        self.pq.writeToFile(alarmsGrouped, f'{location}alarmsGrouped.parquet')
+
+
+    # The jobs whose dataset is missing from the published generation or older than the job's interval.
+    # The completion time is taken from the manifest, so the check is a single small read
+    def staleJobs(self):
+        manifest = readManifest(self.location)
+        now = time.time()
+        stale = []
+        verified = self.readVerified()
+        for dataset, (job, filename) in DATASETS.items():
+            entry = manifest.get(dataset)
+            interval = self.scheduler.jobs[job].interval
+            if entry is None or not os.path.exists(snapshot.resolve(f'{self.location}{filename}')):
+                print(f"{dataset} is not in the cache.")
+                stale.append(job)
+                continue
+            completed = entry['completed']
+            check = verified.get(dataset)
+            if check is not None and check.get('sources') == entry.get('sources'):
+                completed = max(completed, check['verified'])
+            if now - completed > interval:
+                print(f"{dataset} was updated {round(now - completed)} seconds ago.")
+                stale.append(job)
+            else:
+                self.scheduler.jobs[job].next_call = completed + interval
+        return stale
+
+
+    # Records the dataset in the manifest of the generation being built.
+    # The manifest is replaced, not modified, since it is shared with the previous generations
+    # sources are the digests of the downloaded payloads the dataset was built from, see utils/httpcache.py
+    def recordDataset(self, location, dataset, rows, dateFrom=None, dateTo=None, sources=None):
+        filename = os.path.join(location, MANIFEST)
+        manifest = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                manifest = json.load(f)
+        manifest[dataset] = {'job': DATASETS[dataset][0],
+                             'generation': os.path.basename(os.path.normpath(location)),
+                             'rows': rows,
+                             'from': dateFrom,
+                             'to': dateTo,
+                             'completed': round(time.time(), 3)}
+        if sources is not None:
+            manifest[dataset]['sources'] = sources
+        tmp = f'{filename}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, filename)
+
+
+    def readVerified(self):
+        try:
+            with open(f'{self.location}{VERIFIED}') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            print(traceback.format_exc())
+            return {}
+
+    # Records that the sources of the dataset did not change, so it counts as fresh for staleJobs
+    # without publishing a generation only to update the manifest
+    def recordVerified(self, dataset, sources):
+        verified = self.readVerified()
+        verified[dataset] = {'sources': sources, 'verified': round(time.time(), 3)}
+        filename = f'{self.location}{VERIFIED}'
+        tmp = f'{filename}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(verified, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, filename)
+
+
+    # True when the dataset was built from the same payloads and is still in the cache
+    def sourcesUnchanged(self, dataset, sources):
+        entry = readManifest(self.location).get(dataset)
+        return entry is not None and entry.get('sources') == sources \
+               and os.path.exists(snapshot.resolve(f'{self.location}{DATASETS[dataset][1]}'))
+
+
+    # The averages are calculated for 30 minute bins (12 hours for throughput).
+    # ES splits each window into bins and pages through the pairs,
+    # so each window holds several bins instead of querying every bin separately
+    def timeSlices(self, idx, dateFrom, dateTo):
+        interval = 30
         if idx in ['ps_throughput']:
             dateFrom, dateTo = hp.defaultTimeRange(days=21)
-            intv = 42  # 12 hour bins
+            interval = 60*12  # 12 hour bins
 
-        data = []
-        
-        time_list = hp.GetTimeRanges(dateFrom, dateTo, intv)
-        for i in range(len(time_list)-1):
-            data.extend(qrs.query4Avg(idx, time_list[i], time_list[i+1]))
-
-        return data
+        windows = hp.GetTimeWindows(dateFrom, dateTo, interval*hp.BINS_PER_REQUEST)
+        return [(idx, wFrom, wTo, hp.QUERY_TIMEOUT, interval) for wFrom, wTo in windows]
 
 
     @timer
     def cacheIndexData(self):
         dateFrom, dateTo = hp.defaultTimeRange(1)
         INDICES = ['ps_packetloss', 'ps_owd', 'ps_throughput']
+        # the requests for all indices share one pool
+        slices = {idx: self.timeSlices(idx, dateFrom, dateTo) for idx in INDICES}
+        results = hp.runConcurrently(qrs.query4Avg, [s for idx in INDICES for s in slices[idx]])
+
         measures = pd.DataFrame()
+        start = 0
         for idx in INDICES:
-            df = pd.DataFrame(self.queryData(idx, dateFrom, dateTo))
+            data = []
+            for aggrs in results[start:start+len(slices[idx])]:
+                data.extend(aggrs)
+            start += len(slices[idx])
+            df = pd.DataFrame(data)
             # pq.writeToFile(df, f'{location}{idx}.parquet')
             df.loc[:, 'src'] = df['src'].str.upper()
             df.loc[:, 'dest'] = df['dest'].str.upper()
@@ -182,21 +299,30 @@ class ParquetUpdater(object):
             df.loc[:, 'dest_site'] = df['dest_site'].str.upper()
             df['idx'] = idx
             measures = pd.concat([measures, df])
-        self.pq.writeToFile(measures, f'{self.location}raw/measures.parquet')
+        # the dates and the units are computed once here instead of by each plot
+        measures = MeasuresStore.prepare(measures.reset_index(drop=True))
+        with Snapshot(self.location) as location:
+            self.pq.writeToFile(measures, f'{location}{MEASURES_FILE}', nativeDates=True)
+            self.recordDataset(location, 'measures', len(measures), dateFrom, dateTo)
 
     @timer
     def storeMetaData(self):
         metaDf = qrs.getMetaData()
-        self.pq.writeToFile(metaDf, f"{self.location}raw/metaDf.parquet")
+        with Snapshot(self.location) as location:
+            self.pq.writeToFile(metaDf, f"{location}raw/metaDf.parquet")
+            self.recordDataset(location, 'metadata', len(metaDf))
         
     @timer
     def storeCRICData(self):
+        services, rcsites = self.http.get(CRIC_SERVICES), self.http.get(CRIC_RCSITES)
+        sources = {r.url: r.digest for r in [services, rcsites]}
+        if self.sourcesUnchanged('cric', sources):
+            print("The CRIC data did not change.")
+            self.recordVerified('cric', sources)
+            return
+
         all_hosts = []
-        r = requests.get(
-            'https://wlcg-cric.cern.ch/api/core/service/query/?json&state=ACTIVE&type=PerfSonar',
-            verify=False
-        )
-        res = r.json()
+        res = services.json()
         for _key, val in res.items():
             if not val['endpoint']:
                 print('no hostname? should not happen:', val)
@@ -204,11 +330,9 @@ class ParquetUpdater(object):
             p = val['endpoint']
             all_hosts.append(p)
         df = pd.DataFrame(all_hosts, columns=['host'])
-        self.pq.writeToFile(df, f"{self.location}raw/CRICDataHosts.parquet")
         
         subnets = []
-        r = requests.get(
-        'https://wlcg-cric.cern.ch/api/core/rcsite/query/list/?json', verify=False).json()
+        r = rcsites.json()
         for site in CRIC_OPN_RCSITES.keys():
             try:
                 for netroute in r[site]['netroutes'].values():
@@ -221,7 +345,10 @@ class ParquetUpdater(object):
                 print(f'While writing CRICDataOPNSubnets.parquet subnet for {site} was not found.\n')
         df2 = pd.DataFrame(subnets, columns=['site', 'subnets'])
         df2 = df2.groupby('site').agg('sum').reset_index()
-        self.pq.writeToFile(df2, f"{self.location}raw/CRICDataOPNSubnets.parquet")
+        with Snapshot(self.location) as location:
+            self.pq.writeToFile(df, f"{location}raw/CRICDataHosts.parquet")
+            self.pq.writeToFile(df2, f"{location}raw/CRICDataOPNSubnets.parquet")
+            self.recordDataset(location, 'cric', len(df), sources=sources)
     
     @timer
     def validOPNTraceroutes(self):
@@ -229,126 +356,172 @@ class ParquetUpdater(object):
         from_date = to_date - timedelta(hours=2)
         records = qrs.queryOPNTraceroutes(from_date.strftime(hp.DATE_FORMAT), to_date.strftime(hp.DATE_FORMAT), list(CRIC_OPN_RCSITES.values())+["pic-LHCOPNE"]) 
         df = pd.DataFrame(records)
-        self.pq.writeToFile(df, f"{self.location}raw/traceroutes_OPN.parquet")
+        with Snapshot(self.location) as location:
+            self.pq.writeToFile(df, f"{location}raw/traceroutes_OPN.parquet")
+            self.recordDataset(location, 'opn_traceroutes', len(df), from_date.strftime(hp.DATE_FORMAT), to_date.strftime(hp.DATE_FORMAT))
      
 
     @timer
     def psConfigDataAndAudit(self):
-        log = logging.getLogger(__name__)
-        last_modified = datetime.fromtimestamp(Path("parquet/audited_hosts.parquet").stat().st_mtime, tz=timezone.utc)
-        print(f"Host audit last modified: {last_modified}")
-        if last_modified - datetime.now(timezone.utc) > timedelta(hours=24) or not os.path.exists("parquet/audited_hosts.parquet") or not os.path.exists("parquet/raw/psConfigData.parquet"):
-            print("Updating audit...")
-            def request(url, hostcert=None, hostkey=None, verify=False):
-                log.debug('Retrieving {}'.format(url))
-                if hostcert and hostkey:
-                    req = requests.get(url, verify=verify, timeout=120, cert=(hostcert, hostkey))
-                else:
-                    req = requests.get(url, timeout=120, verify=verify)
-                req.raise_for_status()
-                return req.content
-            
-            def extract_host_info(config):
-                hosts = config.get("hosts", {})
-                groups = config.get("groups", {})
-                tasks = config.get("tasks", {})
-                tests = config.get("tests", {})
-                schedules = config.get("schedules", {})
-                group_type_map = {}
-                test_schedule_map = {}
-                for task_name, task_info in tasks.items():
-                    group_name = task_info.get("group")
-                    if group_name:
-                        test_type = tests.get(group_name).get("type")
-                        group_type_map[group_name] = test_type
-                    schedule = task_info.get("schedule")
-                    test_schedule_map[group_name] = schedules.get(schedule, None)
-                # For each host, find groups it belongs to
-                # groups have list of addresses with names
-                # Check which groups contain this host
-                host_rows = []
-                for host in hosts.keys():
-                    participating_groups = []
-                    participating_types = []
-                    participating_schedules = []
-                    participating_tests = []
-
-                    for group_name, group_info in groups.items():
-                        addr_list = group_info.get("addresses", [])
-                        # check if host is in this group's addresses
-                        if any(addr.get("name") == host for addr in addr_list):
-                            participating_groups.append(group_name)
-                            # get type of test associated with group
-                            test_type = group_type_map.get(group_name, None)
-                            if test_type:
-                                participating_types.append(test_type)
-                            # get schedule(s) from tests that belong to this group
-                            # find tests whose group matches group_name
-                            for task_name, task_info in tasks.items():
-                                if task_info.get("group") == group_name:
-                                    schedule = test_schedule_map.get(task_name, {})
-                                    participating_schedules.append(schedule)
-                                    participating_tests.append(group_name)
-                    extract_cric_site = False
-                    row = {
-                        "Host": host,
-                        # "Site": queryNetsiteForHost(host),
-                        "Groups": participating_groups,
-                        "Types": participating_types,
-                        "Schedules": participating_schedules,
-                        "Test Count": len(set(participating_tests))
-                    }
-                    host_rows.append(row)
-                
-                #     print(row)
-                # print("\n\n\n")
-                return host_rows
-            
+        print("Updating audit...")
+        def extract_host_info(config):
+            hosts = config.get("hosts", {})
+            groups = config.get("groups", {})
+            tasks = config.get("tasks", {})
+            tests = config.get("tests", {})
+            schedules = config.get("schedules", {})
+            group_type_map = {}
+            test_schedule_map = {}
+            # the tasks of each group
+            group_tasks = {}
+            for task_name, task_info in tasks.items():
+                group_name = task_info.get("group")
+                if group_name:
+                    test_type = tests.get(group_name).get("type")
+                    group_type_map[group_name] = test_type
+                schedule = task_info.get("schedule")
+                test_schedule_map[group_name] = schedules.get(schedule, None)
+                group_tasks.setdefault(group_name, []).append(task_name)
+            # groups have list of addresses with names,
+            # the groups of each name are kept in the order of the groups
+            name_groups = {}
+            for group_name, group_info in groups.items():
+                for name in {addr.get("name") for addr in group_info.get("addresses", [])}:
+                    name_groups.setdefault(name, []).append(group_name)
+
+            host_rows = []
+            for host in hosts.keys():
+                participating_groups = name_groups.get(host, [])
+                # get type of test associated with each group
+                participating_types = [group_type_map[g] for g in participating_groups if group_type_map.get(g)]
+                # get schedule(s) from the tasks that belong to the groups
+                participating_schedules = [test_schedule_map.get(task_name, {})
+                                           for g in participating_groups for task_name in group_tasks.get(g, [])]
+                participating_tests = {g for g in participating_groups if g in group_tasks}
+                row = {
+                    "Host": host,
+                    # "Site": queryNetsiteForHost(host),
+                    "Groups": participating_groups,
+                    "Types": participating_types,
+                    "Schedules": participating_schedules,
+                    "Test Count": len(participating_tests)
+                }
+                host_rows.append(row)
+            return host_rows
+        
+        
+        index = self.http.get(PSCONFIG)
+        config_st = index.json()
+        # the meshes are downloaded at the same time
+        meshes = hp.runConcurrently(self.http.get, [(e['include'][0],) for e in config_st])
+        sources = {r.url: r.digest for r in [index] + meshes}
+
+        # the hosts are audited on each run, the meshes are only parsed when they change
+        configFile = f"{self.location}raw/psConfigData.parquet"
+        changed = not self.sourcesUnchanged('psconfig_audit', sources) or not os.path.exists(snapshot.resolve(configFile))
+        if changed:
+            configs_df = pd.concat([pd.DataFrame(extract_host_info(mesh.json())) for mesh in meshes],
+                                   ignore_index=True)
+        else:
+            print("The psConfig meshes did not change.")
+            configs_df = self.pq.readFile(configFile)
             
-            url = "https://psconfig.aglt2.org/pub/config"
-            req = request(url)
-            config_st = json.loads(req)
-            configs_df = pd.DataFrame() 
-            for e in config_st:
-                mesh_url = e['include'][0]
-                mesh_r = request(mesh_url)
-
-                
-                mesh_config = json.loads(mesh_r)
-                host_info_list = extract_host_info(mesh_config)  # list of dicts
-                current_df = pd.DataFrame(host_info_list)
-                configs_df = pd.concat([configs_df, current_df], ignore_index=True)
-                
-            all_hosts = configs_df['Host'].unique()
-            audited = asyncio.run(audit(all_hosts))  # <-- your coroutine
-            audited_df = pd.DataFrame(audited)
-                
-            self.pq.writeToFile(configs_df, f"{self.location}raw/psConfigData.parquet")
-            self.pq.writeToFile(audited_df, f"{self.location}audited_hosts.parquet")
+        all_hosts = configs_df['Host'].unique()
+        audited = asyncio.run(audit(all_hosts))  # <-- your coroutine
+        audited_df = pd.DataFrame(audited)
             
-        print("Audit is up-to-date.")
+        with Snapshot(self.location) as location:
+            if changed:
+                self.pq.writeToFile(configs_df, f"{location}raw/psConfigData.parquet")
+            self.pq.writeToFile(audited_df, f"{location}audited_hosts.parquet")
+            self.recordDataset(location, 'psconfig_audit', len(audited_df), sources=sources)
             
+    # The alarms are stored incrementally: only the alarms created after the last
+    # stored created_at (the watermark) are requested and appended to the day partitions
+    # of each event. The partitions older than 30 days get removed.
     @timer
     def storeAlarms(self):
         dateFrom, dateTo = hp.defaultTimeRange(30)
-        print("Update data. Get all alarms for the past 30 days...", dateFrom, dateTo)
-        frames, pivotFrames = self.alarms.getAllAlarms(dateFrom, dateTo)
-        self.groupAlarms(pivotFrames)
-
-        for event,df in pivotFrames.items():
-            if event == 'ASN path anomalies per site':
-                print(df.info())
-            filename = self.alarms.eventCF(event)
-            fdf = frames[event]
-            if len(fdf)>0:
-                self.pq.writeToFile(df, f"parquet/pivot/{filename}.parquet")
-                self.pq.writeToFile(fdf, f"parquet/frames/{filename}.parquet")
+        # the state of the alarms published by this updater, the new generation starts from them
+        state = self.alarms.readState(snapshot.currentGeneration(self.location) or self.location)
+        reload = state is None
+        if reload:
+            print("Update data. Get all alarms for the past 30 days...", dateFrom, dateTo)
+            state = {'created_at': dateFrom, 'next_id': {}}
+        # the alarms of the overlap period which are already stored
+        seen = state.get('seen', {})
+
+        # the scan runs before the snapshot, so that the other jobs can publish meanwhile.
+        # The alarms are turned into frames chunk by chunk as the scan goes on and joined per event
+        print(f"Get the alarms created after {state['created_at']}")
+        newFrames, newPivots = {}, {}
+        watermark = None
+        for frames, pivotFrames, chunkMark, ids in self.alarms.getNewAlarms(state['created_at'], state['next_id'], seen):
+            seen = {**seen, **ids}
+            print("New alarms:", {e: len(df) for e, df in frames.items()})
+            for event, df in pivotFrames.items():
+                if len(frames[event])>0:
+                    newFrames.setdefault(event, []).append(frames[event])
+                    newPivots.setdefault(event, []).append(df)
+            if chunkMark is not None:
+                watermark = chunkMark if watermark is None else max(watermark, chunkMark)
+
+        # the frames, pivots, state, cube and grouped alarms are published together.
+        # If a write fails the generation is discarded and the watermark stays
+        with Snapshot(self.location) as location:
+            if reload:
+                self.clearAlarms(location)
+
+            for event, dfs in newFrames.items():
+                filename = self.alarms.eventCF(event)
+                fdf = pd.concat(dfs)
+                self.pq.writePartitions(fdf, f"{location}frames/{filename}")
+                self.pq.writePartitions(pd.concat(newPivots[event]), f"{location}pivot/{filename}")
+                state['next_id'][event] = int(fdf.index.max()) + 1
+
+            expired = dateFrom[:10]
+            for folder in glob.glob(f"{location}frames/*") + glob.glob(f"{location}pivot/*"):
+                self.pq.dropPartitions(folder, expired)
+
+            if watermark is not None:
+                state['created_at'] = max(watermark, qrs.toEpochMillis(state['created_at']))
+            # only the alarms which the next run queries again have to be remembered
+            since = qrs.toEpochMillis(state['created_at']) - qrs.ALARMS_OVERLAP
+            state['seen'] = {alarmId: createdAt for alarmId, createdAt in seen.items() if createdAt > since}
+            self.alarms.writeState(state, location)
+
+            frames, pivotFrames = self.alarms.loadData(dateFrom, dateTo, location)
+            cube = self.alarms.buildCube(pivotFrames)
+            self.pq.writeToFile(cube, f'{location}{ALARMS_CUBE}', nativeDates=True)
+            self.groupAlarms(cube, list(pivotFrames.keys()), location)
+            self.recordDataset(location, 'alarms', sum(len(df) for df in frames.values()), dateFrom, dateTo)
+
+    @timer
+    def storeSiteReports(self):
+        dateFrom, dateTo = hp.defaultTimeRange(days=7)
+        reports = SiteReports(self.location)
+        # built from the current generation (with the metadata query) before entering the snapshot
+        bundles = reports.build()
+        with Snapshot(self.location) as location:
+            sites = reports.store(location, bundles)
+            self.recordDataset(location, 'site_reports', sites, dateFrom, dateTo)
+
+    # Removes the stored alarms from the given generation, so that they get fully reloaded
+    def clearAlarms(self, location):
+        for folder in ['frames', 'pivot']:
+            for f in glob.glob(os.path.join(location, folder, '*')):
+                if os.path.isdir(f):
+                    shutil.rmtree(f)
+                else:
+                    os.remove(f)
 
     @timer
     def storeASNPathChanged(self):
         dateFrom, dateTo = hp.defaultTimeRange(days=3)
         df = qrs.queryPathAnomaliesDetails(dateFrom, dateTo)
-        self.pq.writeToFile(df, f"parquet/asn_path_changes.parquet")
+        with Snapshot(self.location) as location:
+            self.pq.writeToFile(df, f"{location}asn_path_changes.parquet")
+            self.recordDataset(location, 'asn_path_changes', len(df), dateFrom, dateTo)
 
     def createLocation(self, required_folders):
 
@@ -421,32 +594,3 @@ class ParquetUpdater(object):
         gc.collect()
         end_time = time.time()
         print(f"Finished storePacketLossDataAndModel in {end_time - start_time} seconds")
-
-
-class Scheduler(object):
-    def __init__(self, interval, function, *args, **kwargs):
-        self._timer = None
-        self.interval = interval
-        self.function = function
-        self.args = args
-        self.kwargs = kwargs
-        self.is_running = False
-        self.next_call = time.time()
-        self.start()
-
-    def _run(self):
-        self.is_running = False
-        self.start()
-        self.function(*self.args, **self.kwargs)
-
-    def start(self):
-        if not self.is_running:
-            self.next_call += self.interval
-            self._timer = threading.Timer(self.next_call - time.time(), self._run)
-            self._timer.start()
-            self.is_running = True
-
-    def stop(self):
-        if self._timer:
-            self._timer.cancel()
-        self.is_running = False
@@ -1,7 +1,10 @@
+import asyncio
 import traceback
 from elasticsearch.helpers import scan
 from datetime import datetime, timedelta, timezone
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 from dateutil.parser import parse
 
 import utils.helpers as hp
@@ -27,7 +30,16 @@ def obtainFieldNames(dateFrom):
     return 'src_site', 'dest_site'
 
 
-def queryThroughputIdx(dateFrom, dateTo):
+def queryThroughputIdx(dateFrom, dateTo, interval=None, timeout=None):
+  aggrs = []
+  for page in queryThroughputIdxPages(dateFrom, dateTo, interval=interval, timeout=timeout):
+    aggrs.extend(page)
+  return aggrs
+
+
+# Yields the averages page by page. When interval (in minutes) is set, the period is split
+# into bins of that length by ES, so a wide window replaces many small requests
+def queryThroughputIdxPages(dateFrom, dateTo, interval=None, pageSize=9999, timeout=None):
   # dateFrom = datetime.fromisoformat(dateFrom)
   # dateTo = datetime.fromisoformat(dateTo)
   query = {
@@ -36,8 +48,8 @@ def queryThroughputIdx(dateFrom, dateTo):
         {
           "range": {
             "timestamp": {
-              "gt": dateFrom,
-              "lte": dateTo,
+              "gte": dateFrom,
+              "lt": dateTo,
               "format": "strict_date_optional_time"
             }
           }
@@ -59,11 +71,7 @@ def queryThroughputIdx(dateFrom, dateTo):
   
   src_field_name, dest_field_name = obtainFieldNames(dateFrom)
 
-  aggregations = {
-    "groupby": {
-      "composite": {
-        "size": 9999,
-        "sources": [
+  sources = [
           {
             "ipv6": {
               "terms": {
@@ -114,24 +122,22 @@ def queryThroughputIdx(dateFrom, dateTo):
             }
           },
         ]
-      },
-      "aggs": {
+  aggs = {
         "throughput": {
           "avg": {
                         "field": "throughput"
                     }
                 }
             }
-        }
-    }
 
     #     print(idx, str(query).replace("\'", "\""))
-  aggrs = []
-
-  aggdata = hp.es.search(index='ps_throughput', query=query, aggregations=aggregations, _source=False)
-  for item in aggdata['aggregations']['groupby']['buckets']:
+  for buckets in compositeAggregation('ps_throughput', query, sources, aggs, dateFrom, dateTo,
+                                      interval=interval, pageSize=pageSize, timeout=timeout):
+    aggrs = []
+    for item in buckets:
+      binFrom, binTo = binRange(item, dateFrom, dateTo, interval)
       aggrs.append({'hash': str(item['key']['src'] + '-' + item['key']['dest']),
-                    'from': dateFrom, 'to': dateTo,
+                    'from': binFrom, 'to': binTo,
                     'ipv6': item['key']['ipv6'],
                     'src': item['key']['src'].upper(), 'dest': item['key']['dest'].upper(),
                     'src_host': item['key']['src_host'], 'dest_host': item['key']['dest_host'],
@@ -139,8 +145,49 @@ def queryThroughputIdx(dateFrom, dateTo):
                     'value': item['throughput']['value'],
                     'doc_count': item['doc_count']
                     })
-
-  return aggrs
+    yield aggrs
+
+
+# Runs a composite aggregation and yields the buckets page by page, following after_key
+# until the aggregation is exhausted. When interval (in minutes) is set, the buckets are
+# also split by time with a date_histogram source aligned to dateFrom.
+# The queries cover [dateFrom, dateTo), so no bucket starts at dateTo
+# and the consecutive periods (see timeSlices) do not overlap
+def compositeAggregation(index, query, sources, aggs, dateFrom, dateTo, interval=None, pageSize=9999, timeout=None):
+  if interval:
+    start = hp.parse_datetime_multi(dateFrom).replace(tzinfo=timezone.utc)
+    offset = int(start.timestamp() // 60) % interval
+    sources = [{"bin": {"date_histogram": {"field": "timestamp",
+                                           "fixed_interval": f"{interval}m",
+                                           "offset": f"+{offset}m"}}}] + sources
+
+  client = hp.esClient('aggregation', timeout)
+  after = None
+  while True:
+    composite = {"size": pageSize, "sources": sources}
+    if after:
+      composite["after"] = after
+    aggregations = {"groupby": {"composite": composite, "aggs": aggs}}
+
+    res = client.search(index=index, query=query, aggregations=aggregations, size=0, _source=False)
+    group = res['aggregations']['groupby']
+    if group['buckets']:
+      yield group['buckets']
+
+    after = group.get('after_key')
+    if not after or len(group['buckets']) < pageSize:
+      break
+
+
+# The period covered by a bucket: the time bin when the aggregation was split by time,
+# otherwise the whole queried period
+def binRange(item, dateFrom, dateTo, interval):
+  if not interval or 'bin' not in item['key']:
+    return dateFrom, dateTo
+  start = datetime.fromtimestamp(item['key']['bin']/1000, tz=timezone.utc)
+  end = min(start + timedelta(minutes=interval), hp.parse_datetime_multi(dateTo).replace(tzinfo=timezone.utc))
+  start = max(start, hp.parse_datetime_multi(dateFrom).replace(tzinfo=timezone.utc))
+  return start.strftime(hp.DATE_FORMAT), end.strftime(hp.DATE_FORMAT)
 
 
 def query_ASN_paths_pos_probs(src, dest, dt, ipv):
@@ -188,7 +235,7 @@ def query_ASN_paths_pos_probs(src, dest, dt, ipv):
           }
       }
       # print(str(q).replace('\'', '"'))
-      res = hp.es.search(index='ps_traces_changes', query=q)
+      res = hp.esClient().search(index='ps_traces_changes', query=q)
   except Exception:
       # not found / error
       return []
@@ -214,7 +261,7 @@ def queryPathAnomaliesDetails(dateFrom, dateTo, idx='ps_traces_changes'):
             ]
         }
     }
-    res = hp.es.search(index=idx, query=query, size=10000)
+    res = hp.esClient().search(index=idx, query=query, size=10000)
     # collect every transition record from every hit
     records = []
     for hit in res["hits"]["hits"]:
@@ -224,38 +271,82 @@ def queryPathAnomaliesDetails(dateFrom, dateTo, idx='ps_traces_changes'):
     return df
 
 
+# this is the list of events currently tracked in pSDash interface
+ALLOWED_EVENTS = ['bad owd measurements',
+                  'large clock correction',
+                  'high packet loss',
+                  'complete packet loss',
+                  'high packet loss on multiple links',
+                  'high delay from/to multiple sites',
+                  'high one-way delay',
+                  'firewall issue',
+                  'ASN path anomalies',
+                  'ASN path anomalies per site',
+                  'destination cannot be reached from any',
+                  'destination cannot be reached from multiple',
+                  'source cannot reach any',
+                  'bandwidth decreased',
+                  'bandwidth increased',
+                  'bandwidth increased from/to multiple sites',
+                  'bandwidth decreased from/to multiple sites']
+
+
+# number of alarms turned into frames at once while the scan goes on
+ALARMS_CHUNK = 20000
+# period before the watermark which is queried again for the alarms indexed late
+ALARMS_OVERLAP = 60*60*1000  # ms
+
+
 def queryAlarms(dateFrom, dateTo):
   period = hp.GetTimeRanges(dateFrom, dateTo)
   print(period)
-  # this is the list of events currently tracked in pSDash interface
-  allowed_events = ['bad owd measurements',
-                    'large clock correction',
-                    'high packet loss',
-                    'complete packet loss',
-                    'high packet loss on multiple links',
-                    'high delay from/to multiple sites',
-                    'high one-way delay',
-                    'firewall issue',
-                    'ASN path anomalies',
-                    'ASN path anomalies per site',
-                    'destination cannot be reached from any',
-                    'destination cannot be reached from multiple',
-                    'source cannot reach any',
-                    'bandwidth decreased',
-                    'bandwidth increased',
-                    'bandwidth increased from/to multiple sites',
-                    'bandwidth decreased from/to multiple sites']
+  createdAt = {
+                "gte": period[0],
+                "lte": period[1],
+                "format": "strict_date_optional_time"
+              }
+  try:
+    chunks = {}
+    for frames, watermark, ids in scanAlarms(createdAt):
+      for event, df in frames.items():
+        chunks.setdefault(event, []).append(df)
+    return {event: pd.concat(dfs, ignore_index=True) for event, dfs in chunks.items()}
+  except Exception as e:
+    print('Exception:', e)
+    print(traceback.format_exc())
+
+
+# Yields the alarms created after the given watermark (epoch millis or a date string)
+# chunk by chunk, together with the high-water mark of the field created_at and the _ids of the chunk.
+# The alarms can be indexed after newer ones, so the last ALARMS_OVERLAP before the watermark
+# are queried again and those already stored (seen, {_id: created_at}) are skipped
+def queryNewAlarms(createdAfter, seen=None):
+  print('Get the alarms created after', createdAfter)
+  createdAt = {
+                "gt": toEpochMillis(createdAfter) - ALARMS_OVERLAP,
+                "format": "strict_date_optional_time||epoch_millis"
+              }
+  return scanAlarms(createdAt, seen)
+
+
+def toEpochMillis(created_at):
+  if isinstance(created_at, (int, float)):
+    return int(created_at)
+  return int(pd.Timestamp(created_at).timestamp() * 1000)
+
+
+# Yields ({event: DataFrame}, watermark, {_id: created_at}) for every chunkSize alarms returned by the scan,
+# so only one chunk of raw documents is held in memory at a time.
+# The alarms come in no particular order (a plain scroll is much cheaper than a sorted one),
+# the watermark of the whole scan is the max of the watermarks of its chunks
+def scanAlarms(createdAt, seen=None, chunkSize=ALARMS_CHUNK):
   q = {
         "query": {
             "bool": {
                 "must": [
                     {
                         "range": {
-                            "created_at": {
-                                "gte": period[0],
-                                "lte": period[1],
-                                "format": "strict_date_optional_time"
-                            }
+                            "created_at": createdAt
                         }
                     },
                   {
@@ -268,7 +359,7 @@ def queryAlarms(dateFrom, dateTo):
                     },
                     {
                         "terms": {
-                            "event": allowed_events
+                            "event": ALLOWED_EVENTS
                         }
                     }
                 ]
@@ -276,44 +367,69 @@ def queryAlarms(dateFrom, dateTo):
         }
       }
   # print(str(q).replace("\'", "\""))
-  try:
-    result = scan(client=hp.es, index='aaas_alarms', query=q)
-    data = {}
+  result = scan(client=hp.esClient('scan'), index='aaas_alarms', query=q)
+  seen = seen or {}
+  chunk, ids = [], {}
+  for item in result:
+    if item['_id'] in seen:
+      continue
+    chunk.append(item['_source'])
+    if 'created_at' in item['_source']:
+      ids[item['_id']] = toEpochMillis(item['_source']['created_at'])
+    if len(chunk) >= chunkSize:
+      yield (*alarmFrames(chunk), ids)
+      chunk, ids = [], {}
+  if chunk:
+    yield (*alarmFrames(chunk), ids)
+
+
+# Builds one frame per event from the alarm documents
+# and normalizes the tags and dates column by column
+def alarmFrames(docs):
+  watermark = None
+  created = [toEpochMillis(d['created_at']) for d in docs if 'created_at' in d]
+  if created:
+    watermark = max(created)
+
+  frames = {}
+  events = pd.Series([d['event'] for d in docs])
+  for event, idx in events.groupby(events).groups.items():
+    group = [docs[i] for i in idx if 'source' in docs[i]]
+    if not group:
+      continue
+    df = pd.DataFrame([d['source'] for d in group])
+
+    tags = [d.get('tags') for d in group]
+    withTags = [i for i, t in enumerate(tags) if t is not None]
+    if withTags:
+      arr = pa.array([tags[i] for i in withTags], type=pa.list_(pa.string()))
+      upper = pa.ListArray.from_arrays(arr.offsets, pc.utf8_upper(arr.flatten()))
+      values = df['tag'].tolist() if 'tag' in df.columns else [None] * len(df)
+      for i, t in zip(withTags, upper.to_pylist()):
+        values[i] = t
+      df['tag'] = values
+
+    # the alarms without "to" get the time they were created
+    createdAt = pd.to_datetime(pd.Series([toEpochMillis(d['created_at']) if 'created_at' in d else None for d in group],
+                                         index=df.index, dtype='float64'), unit='ms', utc=True)
+    if 'to' in df.columns:
+      df['to'] = pd.to_datetime(df['to'], utc=True, format='mixed').fillna(createdAt)
+    else:
+      df['to'] = createdAt
+    if 'from' in df.columns:
+      df['from'] = pd.to_datetime(df['from'], utc=True, format='mixed')
 
-    for item in result:
-        event = item['_source']['event']
-        temp = []
-        if event in data.keys():
-            temp = data[event]
+    if 'to_date' in df.columns:
+      day = pd.to_datetime(df['to_date'].str.split('T').str[0], utc=True, format='mixed')
+      df['to'] = day.where(df['to_date'].notna(), df['to'])
 
-        if 'source' in item['_source'].keys():
-          desc = item['_source']['source']
-          if 'tags' in item['_source'].keys():
-            tags = item['_source']['tags']
-            desc['tag'] = [t.upper() for t in tags]
+    if 'avg_value%' in df.columns:
+      df['avg_value'] = df['avg_value%'].combine_first(df['avg_value']) if 'avg_value' in df.columns else df['avg_value%']
+      df = df.drop(columns=['avg_value%'])
 
-          if 'to' not in desc.keys():
-            desc['to'] = pd.to_datetime(item['_source']['created_at'], unit='ms', utc=True)
+    frames[event] = df
 
-          if 'from' in desc.keys() and 'to' in desc.keys():
-            desc['from'] = desc['from'].replace('T', ' ')
-            desc['to'] = desc['to'].replace('T', ' ')
-          
-          if 'to_date' in desc.keys():
-             desc['to'] = desc['to_date'].split('T')[0]
-
-          if 'avg_value%' in desc.keys():
-              desc['avg_value'] = desc['avg_value%']
-              desc.pop('avg_value%')
-          
-          temp.append(desc)
-
-          data[event] = temp
-
-    return data
-  except Exception as e:
-    print('Exception:', e)
-    print(traceback.format_exc())
+  return frames, watermark
 
 
 
@@ -329,7 +445,7 @@ def getASNInfo(ids):
     # print(str(query).replace("\'", "\""))
     asnDict = {}
     try:
-      data = scan(hp.es, index='ps_asns', query=query)
+      data = scan(hp.esClient('scan'), index='ps_asns', query=query)
       if data:
         for item in data:
             asnDict[str(item['_id'])] = item['_source']['owner']
@@ -345,7 +461,7 @@ def getASNInfo(ids):
 # TODO: start querying form ps_meta
 def getMetaData():
     meta = []
-    data = scan(hp.es, index='ps_alarms_meta')
+    data = scan(hp.esClient('scan'), index='ps_alarms_meta')
     for item in data:
         meta.append(item['_source'])
 
@@ -362,7 +478,7 @@ def getAlarm(id):
       }
   }
   data = []
-  results = hp.es.search(index='aaas_alarms', size=100, query=q)
+  results = hp.esClient().search(index='aaas_alarms', size=100, query=q)
   for res in results['hits']['hits']:
     data.append(res['_source'])
 
@@ -380,7 +496,7 @@ def getCategory(event):
   }
 
 
-  results = hp.es.search(index='aaas_categories', query=q)
+  results = hp.esClient().search(index='aaas_categories', query=q)
 
   for res in results['hits']['hits']:
     return res['_source']
@@ -468,7 +584,7 @@ def query_ASN_anomalies(src, dest, dt):
 
   # print(str(q).replace("\'", "\""))
   fields = ['ipv6', 'src_netsite', 'dest_netsite', 'last_appearance_path', 'repaired_asn_path', 'anomalies', 'paths']
-  result = scan(client=hp.es, index='ps_traces_changes', query=q, source=fields)
+  result = scan(client=hp.esClient('scan'), index='ps_traces_changes', query=q, source=fields)
 
   data = []
   for item in result:
@@ -483,22 +599,29 @@ def query_ASN_anomalies(src, dest, dt):
   ddf = pd.DataFrame(data)
   return ddf
 
-def query4Avg(idx, dateFrom, dateTo):
+def query4Avg(idx, dateFrom, dateTo, timeout=None, interval=None):
+  aggrs = []
+  for page in query4AvgPages(idx, dateFrom, dateTo, interval=interval, timeout=timeout):
+    aggrs.extend(page)
+  return aggrs
+
+
+# Streams the averages per pair page by page (see compositeAggregation).
+# With interval (in minutes) the rows are per time bin, 'from' and 'to' being the bin limits
+def query4AvgPages(idx, dateFrom, dateTo, interval=None, pageSize=9999, timeout=None):
   # TODO: stick to 1 date format
   # dateFrom = convertDate(dateFrom)
   # dateTo = convertDate(dateTo)
   val_fld = hp.getValueField(idx)
   src_field_name, dest_field_name = obtainFieldNames(dateFrom)
   query = {
-            "size" : 0,
-            "query" : {
               "bool" : {
                 "must" : [
                   {
                     "range" : {
                       "timestamp" : {
-                        "gt" : dateFrom,
-                        "lte": dateTo,
+                        "gte" : dateFrom,
+                        "lt": dateTo,
                         "format": "strict_date_optional_time"
                       }
                     }
@@ -515,12 +638,8 @@ def query4Avg(idx, dateFrom, dateTo):
                   }
                 ]
               }
-            },
-            "aggregations" : {
-              "groupby" : {
-                "composite" : {
-                  "size" : 9999,
-                  "sources" : [
+            }
+  sources = [
                     {
                       "src" : {
                         "terms" : {
@@ -564,32 +683,28 @@ def query4Avg(idx, dateFrom, dateTo):
                       }
                     }
                   ]
-                },
-                "aggs": {
+  aggs = {
                   val_fld: {
                     "avg": {
                       "field": val_fld
                     }
                   }
                 }
-              }
-            }
-          }
 
-  aggrs = []
-
-  aggdata = hp.es.search(index=idx, body=query, _source=False)
-  for item in aggdata['aggregations']['groupby']['buckets']:
+  for buckets in compositeAggregation(idx, query, sources, aggs, dateFrom, dateTo,
+                                      interval=interval, pageSize=pageSize, timeout=timeout):
+    aggrs = []
+    for item in buckets:
+      binFrom, binTo = binRange(item, dateFrom, dateTo, interval)
       aggrs.append({'pair': str(item['key']['src']+'-'+item['key']['dest']),
                     'src': item['key']['src'], 'dest': item['key']['dest'],
                     'src_host': item['key']['src_host'], 'dest_host': item['key']['dest_host'],
                     'src_site': item['key']['src_site'], 'dest_site': item['key']['dest_site'],
                     'value': item[val_fld]['value'],
-                    'from': dateFrom, 'to': dateTo,
+                    'from': binFrom, 'to': binTo,
                     'doc_count': item['doc_count']
                     })
-
-  return aggrs
+    yield aggrs
 
 
 def queryBandwidthIncreasedDecreased(dateFrom, dateTo, sips, dips, ipv6):
@@ -629,7 +744,7 @@ def queryBandwidthIncreasedDecreased(dateFrom, dateTo, sips, dips, ipv6):
           }
       # print(str(q).replace("\'", "\""))
 
-    result = scan(client=hp.es,index='ps_throughput',query=q)
+    result = scan(client=hp.esClient('scan'),index='ps_throughput',query=q)
     data = []
 
     for item in result:
@@ -641,73 +756,65 @@ def queryBandwidthIncreasedDecreased(dateFrom, dateTo, sips, dips, ipv6):
     df['dt'] = df['timestamp']
     return df
 
-def getSiteMetadata(site, date_from=None, date_to=None, index='ps_meta'):
-    """
-    Fetch metadata using Elasticsearch scan with date range filtering,
-    including cpu_cores, cpus
-    """
+# the number of hosts returned by a request of latestHostsMetadata, at most the max_result_window of ES
+META_HOSTS = 10000
+
+
+def metaPeriodFilter(date_from=None, date_to=None):
     # Set default dates if not provided
     if date_to is None:
         date_to = datetime.utcnow()
     else:
         date_to = datetime.strptime(date_to, '%Y-%m-%d') if isinstance(date_to, str) else date_to
-    
+
     if date_from is None:
         date_from = date_to - timedelta(days=365)
     else:
         date_from = datetime.strptime(date_from, '%Y-%m-%d') if isinstance(date_from, str) else date_from
-    
-    date_format = 'strict_date_optional_time'
-    date_from_str = date_from.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
-    date_to_str = date_to.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+    return {"range": {
+                "timestamp": {
+                    "format": 'strict_date_optional_time',
+                    "gte": date_from.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+                    "lte": date_to.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+                }
+            }}
+
+
+def latestHostsMetadata(filters, index='ps_meta'):
+    """
+    The latest document of each host matching the filters, the most recent first.
+    A single search collapsed on the host, instead of scanning all the documents of the period
+    """
     query = {
-        "query": {
-            "bool": {
-                "filter": [
-                    {"match_phrase": {"netsite": site}},
-                    {"range": {
-                        "timestamp": {
-                            "format": date_format,
-                            "gte": date_from_str,
-                            "lte": date_to_str
-                        }
-                    }}
-                ]
-            }
-        },
-        "sort": [{"timestamp": {"order": "desc", "format": date_format}}],
+        "size": META_HOSTS,
+        "query": {"bool": {"filter": filters}},
+        "collapse": {"field": "host"},
+        "sort": [{"timestamp": {"order": "desc", "format": 'strict_date_optional_time'}}],
         "_source": {
             "includes": ["*", "cpu_cores", "cpus", "wlcg-role"],  # Include all fields plus our specific ones
             "excludes": []  # No exclusions
         }
     }
-    
-    try:
-        results = scan(
-            hp.es,
-            index=index,
-            query=query,
-            preserve_order=True
-        )
-        
-        meta = []
-        for hit in results:
-            doc = hit['_source']
-            # Ensure the fields exist in the document
-            doc.setdefault('cpu_cores', None)
-            doc.setdefault('cpus', None)
-            meta.append(doc)
-        
-        if meta:
-            return pd.DataFrame(meta)
-        else:
-            print(f"No metadata found for site '{site}' between {date_from_str} and {date_to_str}")
-            return None
-            
-    except Exception as e:
-        print(f"Error fetching metadata: {str(e)}")
-        return None
-      
+    res = hp.esClient('search').search(index=index, **query)
+    meta = []
+    for hit in res['hits']['hits']:
+        doc = hit['_source']
+        # Ensure the fields exist in the document
+        doc.setdefault('cpu_cores', None)
+        doc.setdefault('cpus', None)
+        meta.append(doc)
+    return pd.DataFrame(meta) if meta else None
+
+
+# The latest metadata of the hosts of all the sites at once: {netsite: metadata of its hosts}.
+# See model/SiteMetadata.py for the cached variant
+def getSitesMetadata(date_from=None, date_to=None, index='ps_meta'):
+    meta = latestHostsMetadata([{"exists": {"field": "netsite"}}, metaPeriodFilter(date_from, date_to)], index)
+    if meta is None:
+        return {}
+    return {site: df.reset_index(drop=True) for site, df in meta.groupby('netsite', sort=False)}
+
 def queryUnreachableDestination(alarm_name, site, dateTo):
   # period = hp.GetTimeRanges(dateFrom, dateTo)
   # print(period)
@@ -751,7 +858,7 @@ def queryUnreachableDestination(alarm_name, site, dateTo):
 }
   # print(str(q).replace("\'", "\""))
   try:
-    result = scan(client=hp.es, index='aaas_alarms', query=q)
+    result = scan(client=hp.esClient('scan'), index='aaas_alarms', query=q)
     data = {}
 
     for item in result:
@@ -785,50 +892,87 @@ def queryUnreachableDestination(alarm_name, site, dateTo):
     print('Exception:', e)
     print(traceback.format_exc())
 
-def hostFoundInES(host, lookback_days, indeces):
-    """
-    Checks whether host was found in Elasticsearch in the last lookback_days days in ps_trace, ps_throughout or ps_owd indeces.
-    Returns True if found and rcsite + netsite name if available, False otherwise.
-    """
-    since = (datetime.now(timezone.utc) - timedelta(days=lookback_days)).isoformat()
+
+# the host fields of the measurements, searched by hostsFoundInESAsync
+HOST_FIELDS = ['src_host', 'dest_host', 'src', 'dest', 'host']
+# the number of hosts looked up by a single request of hostsFoundInESAsync
+HOSTS_PER_REQUEST = 1000
+
+
+# The request returning the latest document of each host in each of the host fields
+def hostsLastSeenQuery(hosts, since):
+  return {"size": 0,
+          "query": {"bool": {"filter": [
+                      {"range": {"@timestamp": {"gte": since}}},
+                      {"bool": {"should": [{"terms": {f: hosts}} for f in HOST_FIELDS],
+                                "minimum_should_match": 1}}]}},
+          "aggregations": {f: {"terms": {"field": f, "include": hosts, "size": len(hosts)},
+                               "aggs": {"last": {"top_hits": {"size": 1,
+                                                              "sort": [{"@timestamp": "desc"}],
+                                                              "_source": HOST_FIELDS + ['src_netsite', 'src_rcsite',
+                                                                                        'dest_netsite', 'dest_rcsite']}}}}
+                           for f in HOST_FIELDS}}
+
+
+# The latest document of each host, out of the buckets of all host fields
+def hostsLastSeen(res):
+  latest = {}
+  for f in HOST_FIELDS:
+    for bucket in res['aggregations'][f]['buckets']:
+      hit = bucket['last']['hits']['hits'][0]
+      if bucket['key'] not in latest or hit['sort'][0] > latest[bucket['key']]['sort'][0]:
+        latest[bucket['key']] = hit
+  return {host: hit['_source'] for host, hit in latest.items()}
+
+
+# (found, netsite, rcsite) from the latest document of the host
+def hostSite(host, inf):
+  if host in [inf.get('src_host'), inf.get('src')] and 'src_netsite' in inf.keys():
+    return (True, inf['src_netsite'], inf.get('src_rcsite', '-'))
+  if host in [inf.get('dest_host'), inf.get('dest')] and 'dest_netsite' in inf.keys():
+    return (True, inf['dest_netsite'], inf.get('dest_rcsite', '-'))
+  return (True, "-", "-")
+
+
+def hostsLastSeenRequests(hosts, lookback_days, indeces):
+  since = (datetime.now(timezone.utc) - timedelta(days=lookback_days)).isoformat()
+  hosts = list(hosts)
+  return [(idx, hostsLastSeenQuery(hosts[i:i+HOSTS_PER_REQUEST], since))
+          for idx in indeces for i in range(0, len(hosts), HOSTS_PER_REQUEST)]
+
+
+# The results of the requests, in the order of hostsLastSeenRequests.
+# The first index (in the given order) where a host was found gives its site
+def hostsFound(hosts, indeces, searches, responses):
+  seen = {idx: {} for idx in indeces}
+  for (idx, q), res in zip(searches, responses):
+    if res is None:
+      continue
+    seen[idx].update(hostsLastSeen(res))
+
+  found = {}
+  for host in hosts:
+    found[host] = (False, "-", "-")
     for idx in indeces:
-        q = {
-            "size": 1,
-            "query": {
-                "bool": {
-                    "filter": [
-                        {"range": {"@timestamp": {"gte": since}}},
-                        {"bool": {
-                            "should": [
-                                {"term": {"src_host": host}},
-                                {"term": {"dest_host": host}},
-                                {"term": {"src": host}},
-                                {"term": {"dest": host}},
-                                {"term": {"host": host}}
-                            ],
-                            "minimum_should_match": 1
-                        }}
-                    ]
-                }
-            },
-            "sort": [{"@timestamp": "desc"}]
-        }
-        try:
-            res = hp.es.search(index=idx, body=q)
-            hits = res.get("hits", {}).get("hits", [])
-            if len(hits) > 0:
-                inf = hits[0]['_source']
-                if (host in [inf['src_host'], inf['src']]) and ('src_netsite' in inf.keys()):
-                    return (True, inf['src_netsite'], inf['src_rcsite'])
-                if host in [inf['dest_host'], inf['dest']] and ('dest_netsite' in inf.keys()):
-                    return (True, inf['dest_netsite'], inf['dest_rcsite'])
-                return (True, "-", "-")
-        except Exception as e:
-            print("Host: ", host)
-            print("Exception in Elasticsearch query?")
-            print(e)
-            pass
-    return (False, "-", "-")
+      if host in seen[idx]:
+        found[host] = hostSite(host, seen[idx][host])
+        break
+  return found
+
+
+# Looks up many hosts at once: one request per index for every HOSTS_PER_REQUEST hosts,
+# each a terms aggregation per host field with the latest document of each host.
+# The searches are sent at the same time
+async def hostsFoundInESAsync(hosts, lookback_days, indeces):
+  async def search(client, idx, q):
+    try:
+      return await client.options(request_timeout=hp.ES_TIMEOUTS['aggregation']).search(index=idx, **q)
+    except Exception as e:
+      print(f"Exception in the hosts lookup in {idx}:", e)
+  searches = hostsLastSeenRequests(hosts, lookback_days, indeces)
+  async with hp.ConnectES(asynchronous=True) as client:
+    responses = await asyncio.gather(*[search(client, idx, q) for idx, q in searches])
+  return hostsFound(hosts, indeces, searches, responses)
   
   # def queryOPNTraceroutes(dateFrom, dateTo, allowed_sites=None, page_size=2000):
     # """
@@ -964,7 +1108,7 @@ def queryOPNTraceroutes(date_from_str, date_to_str, allowed):
     }
 
     try:
-        es_resp = hp.es.search(index='ps_trace', query=q, size=10000)
+        es_resp = hp.esClient().search(index='ps_trace', query=q, size=10000)
         data = es_resp['hits']['hits']
     except Exception as exc:
         print(f"Failed to query ps_trace: {exc}")
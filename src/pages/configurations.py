@@ -7,6 +7,7 @@ from datetime import datetime, timedelta
 
 import utils.helpers as hp
 from utils.parquet import Parquet
+import utils.snapshot as snapshot
 from utils.utils import buildMap, generateStatusTable, get_color
 from dash import dash_table as dt
 import numpy as np
@@ -906,7 +907,7 @@ def render_audit(f_status, f_incric, f_found, f_netsite, data, last_modified, co
     try:
         pq = Parquet()
         df = readParquetToDf(pq, 'parquet/audited_hosts.parquet')
-        last_modified = datetime.fromtimestamp(Path("parquet/audited_hosts.parquet").stat().st_mtime, tz=timezone.utc)
+        last_modified = datetime.fromtimestamp(Path(snapshot.resolve("parquet/audited_hosts.parquet")).stat().st_mtime, tz=timezone.utc)
         data, last_modified = df.to_dict("records"), f"Using cached audit from {last_modified:%Y-%m-%d %H:%M:%S} UTC"
     except Exception as e:
         print(e)
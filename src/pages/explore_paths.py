@@ -40,9 +40,12 @@ dash.register_page(
 )
 
 # Utility: robust parquet reader with error handling
+# the alarm frames are stored as folders with one file per day
 def read_parquet_safe(path):
     try:
-        df = pd.read_parquet(path)
+        if path.endswith('.parquet'):
+            return pq.readFile(path)
+        df = pq.readPartitions(path)
         return df
     except Exception as e:
         return pd.DataFrame()
@@ -71,7 +74,7 @@ def get_dropdown_data(asn_anomalies, pivotFrames):
 
 @timer
 def layout(q=None, **other_unknown_query_strings):
-    asn_anomalies = read_parquet_safe('parquet/frames/ASN_path_anomalies.parquet')
+    asn_anomalies = read_parquet_safe('parquet/frames/ASN_path_anomalies')
     if asn_anomalies.empty:
             return dbc.Row([
                 dbc.Col([
@@ -269,7 +272,7 @@ def hide_loading_after_startup(loading_state, children):
 )
 def update_figures(n_clicks, asnStateValue, sitesStateValue, dateFrom, dateTo):
     if n_clicks is not None:
-        asn_anomalies = read_parquet_safe('parquet/frames/ASN_path_anomalies.parquet')
+        asn_anomalies = read_parquet_safe('parquet/frames/ASN_path_anomalies')
         sitesState = sitesStateValue if sitesStateValue else []
         asnState = asnStateValue if asnStateValue else []
         parallel_cat_fig = get_parallel_cat_fig(sitesState, asnState, dateFrom, dateTo)
@@ -9,11 +9,14 @@ import plotly.express as px
 
 import pandas as pd
 from datetime import date
+from flask import request
 
 from model.Alarms import Alarms
+from model.SiteDirectory import SiteDirectory
 import utils.helpers as hp
 from utils.helpers import timer
 from utils.parquet import Parquet
+from utils.memo import pageCache
 import pycountry
 from utils.utils import buildMap, generateStatusTable, explainStatuses
 # import psconfig.api
@@ -38,8 +41,7 @@ def get_country_code(country_name):
 
 
 def total_number_of_alarms(sitesDf):
-    metaDf = pq.readFile('parquet/raw/metaDf.parquet')
-    sitesDf = pd.merge(sitesDf, metaDf[['lat', 'lon', 'country']], on=['lat', 'lon'], how='left').drop_duplicates()
+    sitesDf = pd.merge(sitesDf, SiteDirectory.load().countries, on=['lat', 'lon'], how='left').drop_duplicates()
     site_totals = sitesDf.groupby('site')[['Infrastructure', 'Network', 'Other']].sum()
 
     highest_site = site_totals.sum(axis=1).idxmax()
@@ -117,27 +119,33 @@ pq = Parquet()
 alarmsInst = Alarms()
 
 
-def layout(**other_unknown_query_strings):
-    dateFrom, dateTo = hp.defaultTimeRange(2)
-    now = hp.defaultTimeRange(days=2, datesOnly=True)
+def siteOverview():
     alarmCnt = pq.readFile('parquet/alarmsGrouped.parquet')
     # if 'tag' in alarmCnt.columns:
     #     alarmCnt['tag'] = alarmCnt['tag'].str.upper()
     # if 'site' in alarmCnt.columns:
     #     alarmCnt['site'] = alarmCnt['site'].str.upper()
     statusTable, sitesDf = generateStatusTable(alarmCnt)
-    print("Period:", dateFrom," - ", dateTo)
     print(f'Number of alarms: {len(alarmCnt)}')
-    
+    return {'statusTable': statusTable, 'map': buildMap(sitesDf), 'totals': total_number_of_alarms(sitesDf)}
+
 
-    total_number = total_number_of_alarms(sitesDf)
+def layout(**other_unknown_query_strings):
+    dateFrom, dateTo = hp.defaultTimeRange(2)
+    now = hp.defaultTimeRange(days=2, datesOnly=True)
+    print("Period:", dateFrom," - ", dateTo)
+
+    # the status table, the map and the totals change only with the data,
+    # the links of the table point to the host of the request
+    overview = pageCache.memoize('home.layout', (request.host_url,), siteOverview)
+    statusTable, siteMap, total_number = overview['statusTable'], overview['map'], overview['totals']
     return html.Div([
         dbc.Col([
                 dbc.Row([
                     dbc.Row([
                         # Top left column with the map and the stacked bar chart
                             dbc.Col([
-                                dbc.Col(dcc.Graph(figure=buildMap(sitesDf), id='site-map',
+                                dbc.Col(dcc.Graph(figure=siteMap, id='site-map',
                                             className='cls-site-map', style={'height': '100%'}),
                                     className='boxwithshadow page-cont mb-1 g-0 p-2 column-margin h-flex',
                                     xl=12, lg=12, style={"background-color": "#b9c4d4;", "padding-top": "3%"}
@@ -323,62 +331,66 @@ def update_output(n_clicks, start_date, end_date, sites, all, events, allevents,
             start_date, end_date = hp.defaultTimeRange(days=2)
         start_date = pd.Timestamp(start_date).replace(hour=0, minute=0, second=0, microsecond=0).isoformat()
         end_date = pd.Timestamp(end_date).replace(hour=23, minute=59, second=59, microsecond=0).isoformat()
-         
-        alarmsInst = Alarms()
-        frames, pivotFrames = alarmsInst.loadData(start_date, end_date)
-
-        scntdf = pd.DataFrame()
-        for e, df in pivotFrames.items():
-            if len(df) > 0:
-                df['tag'] = df['tag'].str.upper()
-                if 'site' in df.columns:
-                    df['site'] = df['site'].str.upper()
-                df = df[df['tag'] != ''].groupby('tag')[['id']].count().reset_index().rename(columns={'id': 'cnt', 'tag': 'site'})
-                df['event'] = e
-                scntdf = pd.concat([scntdf, df])
-
-        # sites
-        graphData = scntdf
-        if (sitesState is not None and len(sitesState) > 0):
-            graphData = graphData[graphData['site'].isin(sitesState)]
-
-        sites_dropdown_items = []
-        for s in sorted(scntdf['site'].unique()):
-            if s:
-                sites_dropdown_items.append({"label": s.upper(), "value": s.upper()})
-
-        # events
-        if eventsState is not None and len(eventsState) > 0:
-            graphData = graphData[graphData['event'].isin(eventsState)]
-
-        events_dropdown_items = []
-        for e in sorted(scntdf['event'].unique()):
-            events_dropdown_items.append({"label": e, "value": e})
-
-
-        bar_chart = create_bar_chart(graphData)
-
-        dataTables = []
-        events = list(pivotFrames.keys()) if not eventsState or events else eventsState
-        print("EVENTS")
-        print(events)
-        for event in sorted(events):
-            df = pivotFrames[event]
+
+        # the same search in the same generation gets the stored result
+        params = (start_date, end_date, tuple(sitesState or []), tuple(eventsState or []), bool(events))
+        return pageCache.memoize('home.update_output', params,
+                                 lambda: searchAlarms(start_date, end_date, events, sitesState, eventsState))
+    else:
+        raise dash.exceptions.PreventUpdate
+
+
+def searchAlarms(start_date, end_date, events, sitesState, eventsState):
+    alarmsInst = Alarms()
+    frames, pivotFrames = alarmsInst.loadData(start_date, end_date)
+
+    # the number of pivot rows per site and event
+    cube = alarmsInst.loadCube(start_date, end_date, pivotFrames)
+    scntdf = cube.groupby(['site', 'event'])['rows'].sum().reset_index().rename(columns={'rows': 'cnt'})
+
+    # sites
+    graphData = scntdf
+    if (sitesState is not None and len(sitesState) > 0):
+        graphData = graphData[graphData['site'].isin(sitesState)]
+
+    sites_dropdown_items = []
+    for s in sorted(scntdf['site'].unique()):
+        if s:
+            sites_dropdown_items.append({"label": s.upper(), "value": s.upper()})
+
+    # events
+    if eventsState is not None and len(eventsState) > 0:
+        graphData = graphData[graphData['event'].isin(eventsState)]
+
+    events_dropdown_items = []
+    for e in sorted(scntdf['event'].unique()):
+        events_dropdown_items.append({"label": e, "value": e})
+
+
+    bar_chart = create_bar_chart(graphData)
+
+    dataTables = []
+    events = list(pivotFrames.keys()) if not eventsState or events else eventsState
+    print("EVENTS")
+    print(events)
+    for event in sorted(events):
+        df = pivotFrames[event]
+        # the sites are listed in upper case, as they are in the cube
+        if len(df) > 0:
+            df['tag'] = df['tag'].str.upper()
             if 'site' in df.columns:
-                # df['site'] = df['site'].str.upper()
-                df = df[df['site'].isin(sitesState)] if sitesState is not None and len(sitesState) > 0 else df
-            elif 'tag' in df.columns:
-                # df['tag'] = df['tag'].str.upper()
-                df = df[df['tag'].isin(sitesState)] if sitesState is not None and len(sitesState) > 0 else df
+                df['site'] = df['site'].str.upper()
+        if 'site' in df.columns:
+            df = df[df['site'].isin(sitesState)] if sitesState is not None and len(sitesState) > 0 else df
+        elif 'tag' in df.columns:
+            df = df[df['tag'].isin(sitesState)] if sitesState is not None and len(sitesState) > 0 else df
 
-            if len(df) > 0:
-                dataTables.append(generate_tables(frames[event], df, event, alarmsInst))
-        dataTables = html.Div(dataTables)
+        if len(df) > 0:
+            dataTables.append(generate_tables(frames[event], df, event, alarmsInst))
+    dataTables = html.Div(dataTables)
 
+    return [sites_dropdown_items, events_dropdown_items, dcc.Graph(figure=bar_chart), dataTables]
 
-        return [sites_dropdown_items, events_dropdown_items, dcc.Graph(figure=bar_chart), dataTables]
-    else:
-        raise dash.exceptions.PreventUpdate 
 
 @dash.callback(
     [
@@ -155,7 +155,7 @@ def layout(q=None, **other_unknown_query_strings):
                             children=generate_tables(q, dateFrom, dateTo, frames, pivotFrames, alarmCnt, alarmsInst),
                             ),
                 html.Div(id='measurements',
-                            children=siteMeasurements(q, pq),
+                            children=siteMeasurements(q),
                             ),
                 html.Br(),
                 
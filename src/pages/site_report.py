@@ -4,7 +4,6 @@ It summarises all the alarms per site.
 """
 
 
-from datetime import datetime, timedelta
 from itertools import combinations
 
 import dash
@@ -19,10 +18,10 @@ from plotly.subplots import make_subplots
 import pandas as pd
 
 from model.Alarms import Alarms
+from model.SiteReports import SiteReports, ALARM_COLUMNS
 import utils.helpers as hp
 from utils.helpers import timer
 import model.queries as qrs
-from utils.parquet import Parquet
 from utils.utils import defineStatus, explainStatuses, generate_graphs, getSitePairs, getRawDataFromES
 from utils.components import siteMeasurements, pairDetails, loss_delay_kibana, bandwidth_increased_decreased, throughput_graph_components, asnAnomalesPerSiteVisualisation
 from collections import Counter
@@ -48,128 +47,67 @@ dash.register_page(
 
 # site = None
 alarmsInst = Alarms()
+siteReports = SiteReports()
 
 def layout(q=None, **other_unknown_query_strings):
     # global site
-    pq = Parquet()
     site = q
-    alarmCnt = pq.readFile('parquet/alarmsGrouped.parquet')
-    alarmCnt = alarmCnt[alarmCnt['site'] == site]
-    if q is not None:
-        metaData = qrs.getSiteMetadata(q)
-        print(metaData)
-        if (metaData is None) and alarmCnt.empty:
-            return html.Div(
-                        className="boxwithshadow",
-                        style={
-                            'padding': '20px',
-                            'text-align': 'center',
-                            'margin': '10px 0'
-                        },
-                        children=[
-                            html.Div(
-                                html.I(className="fa fa-times-circle",
-                                    style={'color': 'red', 'font-size': '48px'}),
-                                style={'margin-bottom': '15px'}
-                            ),
-                            html.H4("No Data Found", style={'margin-bottom': '10px'}),
-                            html.P(f"The site name {q} is missing in meta data. It is impossible to generate a report on the site.")
-                        ]
-                    )
-    
-    now = datetime.now()
-    current_hour = pd.Timestamp.now().hour
-    fromDate = (now - timedelta(days=6)).replace(hour=current_hour, minute=0, second=0, microsecond=0)
-    toDate = now.replace(hour=current_hour, minute=0, second=0, microsecond=0) #as in queries we extract based on created_at, to get all the alarms we need to get up to now and after that filter the data by 'to' to get a week of data and end report with date 48hours earlier
-    # toDay = toDay_date.strftime('%Y-%m-%dT%H:%M:%S.000Z')  # "2024-02-26 23:59:59"
-    
-    global pivotFrames
+    # the alarms, statuses and metadata of the site are prepared by the updater, see model/SiteReports.py
+    report = siteReports.report(q)
+    if report.get('preparing'):
+        return html.Div(
+                    className="boxwithshadow",
+                    style={
+                        'padding': '20px',
+                        'text-align': 'center',
+                        'margin': '10px 0'
+                    },
+                    children=[
+                        html.Div(
+                            html.I(className="fa fa-hourglass-half",
+                                style={'color': '#00245a', 'font-size': '48px'}),
+                            style={'margin-bottom': '15px'}
+                        ),
+                        html.H4("The report is being prepared", style={'margin-bottom': '10px'}),
+                        html.P(f"The report on {q} is not ready yet. Please come back in a few minutes.")
+                    ]
+                )
+    if not report['found']:
+        return html.Div(
+                    className="boxwithshadow",
+                    style={
+                        'padding': '20px',
+                        'text-align': 'center',
+                        'margin': '10px 0'
+                    },
+                    children=[
+                        html.Div(
+                            html.I(className="fa fa-times-circle",
+                                style={'color': 'red', 'font-size': '48px'}),
+                            style={'margin-bottom': '15px'}
+                        ),
+                        html.H4("No Data Found", style={'margin-bottom': '10px'}),
+                        html.P(f"The site name {q} is missing in meta data. It is impossible to generate a report on the site.")
+                    ]
+                )
 
+    period = report['period']
+    now = pd.Timestamp(period['now'])
+    fromDate = pd.Timestamp(period['fromDate'])
+    toDate = pd.Timestamp(period['toDate']) #as in queries we extract based on created_at, to get all the alarms we need to get up to now and after that filter the data by 'to' to get a week of data and end report with date 48hours earlier
+    start_date, end_date = period['start_date'], period['end_date']
     full_dates = pd.date_range(start=fromDate, end=toDate).to_list()
-    
-    
-    
-    
-    # dateFrom, dateTo = hp.defaultTimeRange(2)
-    # now = hp.defaultTimeRange(days=2, datesOnly=True)
-    start_date, end_date = hp.defaultTimeRange(days=7)
-    alarmsInst = Alarms()
-    frames, pivotFrames = alarmsInst.loadData(start_date, end_date)
     print(f"fromDay: {start_date}, toDay: {end_date}")
-    
-    
-    
-    site_alarms = pd.DataFrame(columns=["to", "alarm group", "alarm name", "hosts", "IP version", "Details", 'cnt'])
-    site_alarms_num = 0
-    subcategories = qrs.getSubcategories()
-    keys_to_remove = [
-                        'path changed between sites',
-                        'path changed',
-                        'ASN path anomalies'
-                    ]
-    for key in keys_to_remove:
-        frames.pop(key, None)
-
-    # prepare table with alarms
-    for frame in frames:
-        df = frames[frame]
-        # df = df[(pd.to_datetime(df['to']).dt.date >= fromDay_date.date()) & (pd.to_datetime(df['to']).dt.date <= toDay_date.date())]
-        site_df = df[df['tag'].apply(lambda x: q in x)]
-        
-        if not site_df.empty:
-            print(frame)
-            print("----------------")
-            # print(site_df.head(5))
-            site_df['to'] = pd.to_datetime(site_df['to'], errors='coerce')
-            
-            # drop time
-            site_df['to'] = site_df['to'].dt.normalize()  # or .dt.floor('D')
-            site_df['to'] = site_df['to'].dt.strftime('%Y-%m-%d')
-            site_df = alarmsInst.formatDfValues(site_df, frame, False, True)
-            if 'hosts' in site_df.columns:
-                site_df['hosts'] = site_df['hosts'].apply(lambda x: html.Div([html.Div(item) for item in x.split('\n')]) if isinstance(x, str) else x)
-            site_alarms_num += len(site_df)
-            site_df.reset_index(drop=True, inplace=True)
-            for i, alarm in site_df.iterrows():
-                add_hosts = 'hosts'
-                if 'host' in alarm:
-                    add_hosts = 'host'
-                new_row = {
-                    # 'from': alarm.get('from', '"from" field not found'),
-                    'to': alarm.get('to', '"to" field not found'),
-                    'alarm group': subcategories[subcategories['event'] == frame]['category'].values[0],
-                    'alarm name': frame,
-                    'IP version': alarm.get('IP version', None),  # Added IP version if available
-                    'hosts': alarm[add_hosts] if add_hosts in alarm else None,
-                    'Details': alarm.get('alarm_link', None),  # Added Details if available
-                    'cnt': alarm.get('total_paths_anomalies', 1)
-                }
-                dest_site_fields = ['sites', 'cannotBeReachedFrom', 'to_dest_loss', 'from_src_loss', 'src_sites', 'dest_sites', 'dest_netsite', 'dest_site', 'src_site', 'src_netsite']  # ordered by priority if multiple exist
-                destination_sites = []
-                for field in dest_site_fields:
-                    if field in alarm.keys():
-                        destination_sites = destination_sites + [html.Div(item) for item in alarm[field].split('\n')]
-                new_row['Involved Site(s)'] = destination_sites
-                site_alarms = pd.concat([site_alarms, pd.DataFrame([new_row])], ignore_index=True)
 
+    site_alarms = pd.DataFrame(report['alarms'], columns=ALARM_COLUMNS)
+    site_alarms_num = len(site_alarms)
+    site_status = pd.DataFrame(report['status'], columns=['to', 'alarm name', 'cnt'])
     print(f"Total alarms collected: {site_alarms_num}")
-     # extract meta data like CPU, country and hosts
-    meta_df = qrs.getMetaData()
-    meta_df['host_ip'] = meta_df.apply(
-        lambda row: (row['host'], 'ipv6' if row['ipv6'] else 'ipv4'),
-        axis=1
-    )
-    meta_df_site = meta_df[meta_df['site'] == q]
-    hosts_ip = meta_df_site["host_ip"].tolist()
+
+    hosts_ip = report['hosts']
     if len(hosts_ip) < 1:
         hosts_ip = [("hosts information not available", '-')]
-
-    country = meta_df_site["country"].values[0] if len(meta_df_site) > 0 else None
-    site_meta_data = qrs.getSiteMetadata(q)
-    if site_meta_data is not None:
-        cpus, cpu_cores = site_meta_data.iloc[0]['cpus'], site_meta_data.iloc[0]['cpu_cores']
-    else:
-        cpus, cpu_cores = None, None
+    country, cpus, cpu_cores = report['country'], report['cpus'], report['cpu_cores']
     if site_alarms_num == 0:
         return html.Div([
                 dbc.Col([
@@ -190,7 +128,7 @@ def layout(q=None, **other_unknown_query_strings):
                                         html.Div(
                                             dcc.Graph(
                                                 id="site-status-alarms",
-                                                figure=create_status_chart_explained(site_alarms, start_date, end_date, full_dates),
+                                                figure=create_status_chart_explained(site_status, start_date, end_date, full_dates),
                                                 config={'displayModeBar': False},
                                                 style={
                                                     'width': '100%',
@@ -335,7 +273,7 @@ def layout(q=None, **other_unknown_query_strings):
                     
                 # general websites' measurements
                 html.Div(id='site-measurements',
-                        children=siteMeasurements(q, pq),
+                        children=siteMeasurements(q),
                         style={
                             'width': "99%",
                             'justify-self': 'center',
@@ -401,7 +339,7 @@ def layout(q=None, **other_unknown_query_strings):
                                         html.Div(className="h-full", children=[
                                             dcc.Graph(
                                                 id="site-status-alarms",
-                                                figure=create_status_chart_explained(site_alarms, start_date, end_date, full_dates),
+                                                figure=create_status_chart_explained(site_status, start_date, end_date, full_dates),
                                                 config={'displayModeBar': False},
                                                 style={
                                                 }
@@ -694,7 +632,7 @@ def layout(q=None, **other_unknown_query_strings):
                         # general websites' measurements
                         dbc.Row([
                             html.Div(id='site-measurements',
-                                    children=siteMeasurements(q, pq),
+                                    children=siteMeasurements(q),
                                     style={'margin-top': "10px"},
                                                 ),
                         ], className="my-3 pl-1"),
@@ -1314,7 +1252,8 @@ def toggle_collapse_2(n, pair, alarm, is_open):
                         baseline[baseline['pair']==pair],
                         altPaths[altPaths['pair']==pair],
                         posDf[posDf['pair']==pair],
-                        pivotFrames,
+                        # the other alarms come from the index of the stored alarms
+                        None,
                         alarmsInst)
       return [not is_open, data]
     return [is_open, data]
@@ -0,0 +1,165 @@
+import functools
+import glob
+import os
+
+import pandas as pd
+import pytest
+
+import model.queries as qrs
+import utils.snapshot as snapshot
+from model.Alarms import Alarms
+from model.Updater import ParquetUpdater
+from utils.parquet import Parquet
+
+EVENT = 'high packet loss'
+
+
+# Stands for the aaas_alarms index: scan() returns the documents matching the created_at range
+# in the order they were indexed, as a plain scroll does
+class FakeIndex(object):
+
+    def __init__(self):
+        self.docs = []
+        self.scans = []
+
+    def add(self, _id, created, to=None, site='SITE-A'):
+        created = pd.Timestamp(created)
+        to = pd.Timestamp(to) if to is not None else created
+        self.docs.append({'_id': _id,
+                          '_source': {'event': EVENT,
+                                      'category': 'Networking',
+                                      'created_at': created.isoformat(),
+                                      'tags': [site.lower()],
+                                      'source': {'site': site,
+                                                 'from': (to - pd.Timedelta(hours=1)).isoformat(),
+                                                 'to': to.isoformat(),
+                                                 'avg_value': 0.5}}})
+
+    def scan(self, client, index, query):
+        createdAt = query['query']['bool']['must'][0]['range']['created_at']
+        self.scans.append(createdAt)
+        for doc in self.docs:
+            created = qrs.toEpochMillis(doc['_source']['created_at'])
+            if 'gt' in createdAt and created <= createdAt['gt']:
+                continue
+            yield doc
+
+
+@pytest.fixture
+def index(monkeypatch):
+    index = FakeIndex()
+    monkeypatch.setattr(qrs, 'scan', index.scan)
+    monkeypatch.setattr(qrs.hp, 'esClient', lambda *args: None)
+    # small chunks, so that a run is made of several of them
+    monkeypatch.setattr(qrs, 'scanAlarms', functools.partial(qrs.scanAlarms, chunkSize=2))
+    return index
+
+
+# The updater without the scheduler and the warm up, i.e. without the other jobs
+@pytest.fixture
+def updater(tmp_path, monkeypatch):
+    location = f'{tmp_path}/parquet/'
+    for folder in ['raw', 'frames', 'pivot']:
+        os.makedirs(f'{location}{folder}')
+    updater = object.__new__(ParquetUpdater.__wrapped__)
+    updater.pq = Parquet()
+    updater.alarms = Alarms()
+    updater.location = location
+    # the grouped alarms need the stored metadata, they are not part of the ingestion
+    monkeypatch.setattr(updater, 'groupAlarms', lambda cube, events, location: None)
+    monkeypatch.setattr(updater.alarms, 'getAllAlarms', lambda dateFrom, dateTo: ({}, {}))
+    return updater
+
+
+def ago(**kwargs):
+    return pd.Timestamp.now(tz='UTC') - pd.Timedelta(**kwargs)
+
+
+def state(updater):
+    return Alarms.readState(snapshot.currentGeneration(updater.location))
+
+
+def stored(updater):
+    folder = f'{snapshot.currentGeneration(updater.location)}/frames/{Alarms.eventCF(EVENT)}'
+    return Parquet.readPartitions(folder, nativeDates=True).sort_values('id')
+
+
+def test_first_run(index, updater):
+    index.add('a', ago(hours=2, minutes=30))
+    index.add('b', ago(hours=2))
+    index.add('c', ago(hours=4))
+    updater.storeAlarms()
+
+    df = stored(updater)
+    assert len(df) == 3
+    assert df['id'].tolist() == [0, 1, 2]
+    s = state(updater)
+    assert s['next_id'] == {EVENT: 3}
+    # the watermark is the latest alarm, whatever the order of the scan
+    assert s['created_at'] == qrs.toEpochMillis(index.docs[1]['_source']['created_at'])
+    # c is before the overlap, the next run does not query it again
+    assert set(s['seen']) == {'a', 'b'}
+
+
+def test_overlapping_runs(index, updater):
+    index.add('a', ago(hours=3))
+    index.add('b', ago(hours=2))
+    updater.storeAlarms()
+    watermark = state(updater)['created_at']
+
+    # indexed after b, but created before it, within the overlap
+    index.add('late', ago(hours=2, minutes=30))
+    index.add('d', ago(hours=1))
+    updater.storeAlarms()
+
+    assert index.scans[-1]['gt'] == watermark - qrs.ALARMS_OVERLAP
+    df = stored(updater)
+    assert len(df) == 4
+    assert df['id'].tolist() == [0, 1, 2, 3]
+    s = state(updater)
+    assert s['next_id'] == {EVENT: 4}
+    assert s['created_at'] == qrs.toEpochMillis(index.docs[-1]['_source']['created_at'])
+    # b is before the overlap of the new watermark
+    assert set(s['seen']) == {'d'}
+
+
+def test_empty_run(index, updater):
+    index.add('a', ago(hours=3))
+    index.add('b', ago(minutes=30))
+    updater.storeAlarms()
+    before = state(updater)
+
+    updater.storeAlarms()
+
+    # b is queried again and skipped
+    assert len(stored(updater)) == 2
+    assert state(updater) == before
+
+
+def test_expired_partitions_dropped(index, updater):
+    index.add('old', ago(hours=2), to=ago(days=40))
+    index.add('new', ago(hours=1))
+    updater.storeAlarms()
+
+    df = stored(updater)
+    assert df['id'].tolist() == [1]
+    generation = snapshot.currentGeneration(updater.location)
+    days = [os.path.basename(f) for f in glob.glob(f'{generation}/*/{Alarms.eventCF(EVENT)}/*')]
+    assert days and all(day >= ago(days=30).strftime('%Y-%m-%d') for day in days)
+
+
+def test_failed_write_keeps_the_state(index, updater, monkeypatch):
+    index.add('a', ago(hours=3))
+    updater.storeAlarms()
+    current, before = snapshot.currentGeneration(updater.location), state(updater)
+
+    index.add('b', ago(hours=1))
+
+    def fail(*args, **kwargs):
+        raise IOError('disk full')
+    monkeypatch.setattr(updater.pq, 'writePartitions', fail)
+    with pytest.raises(IOError):
+        updater.storeAlarms()
+
+    assert snapshot.currentGeneration(updater.location) == current
+    assert state(updater) == before
@@ -0,0 +1,120 @@
+import os
+
+import pandas as pd
+import pytest
+
+from utils.parquet import FrameCache, Parquet, frameCache, releaseReplaced
+
+
+@pytest.fixture(autouse=True)
+def emptyCache():
+    frameCache.clear()
+    yield
+    frameCache.clear()
+
+
+def frame(rows=10):
+    return pd.DataFrame({'site': ['SITE-A'] * rows, 'value': range(rows)})
+
+
+def write(df, filename):
+    Parquet.writeToFile(df, str(filename), nativeDates=True)
+    return str(filename)
+
+
+def test_eviction_within_the_budget():
+    df = frame()
+    nbytes = int(df.memory_usage(deep=True).sum())
+    cache = FrameCache(budget=2 * nbytes)
+    cache.put('a', 1, df)
+    cache.put('b', 1, frame())
+    # a is used more recently than b
+    assert cache.get('a', 1) is df
+    cache.put('c', 1, frame())
+
+    assert list(cache.entries) == ['a', 'c']
+    assert cache.size == 2 * nbytes
+    assert cache.get('b', 1) is None
+
+
+def test_frames_over_the_budget_are_not_kept():
+    cache = FrameCache(budget=10)
+    cache.put('a', 1, frame())
+    assert cache.get('a', 1) is None
+    assert cache.size == 0
+
+
+def test_get_with_another_key():
+    cache = FrameCache()
+    cache.put('a', (1, 100), frame())
+    assert cache.get('a', (2, 100)) is None
+    assert cache.get('a', (1, 100)) is not None
+
+
+def test_read_file_is_cached(tmp_path):
+    filename = write(frame(), tmp_path / 'a.parquet')
+    first = Parquet.readFile(filename)
+    second = Parquet.readFile(filename)
+    assert len(frameCache.entries) == 1
+    pd.testing.assert_frame_equal(first, second)
+
+
+def test_read_file_after_a_change(tmp_path):
+    filename = write(frame(), tmp_path / 'a.parquet')
+    Parquet.readFile(filename)
+
+    # the same inode and size, another modification time
+    st = os.stat(filename)
+    df = frame()
+    df['site'] = 'SITE-B'
+    write(df, filename + '.new')
+    with open(filename + '.new', 'rb') as src, open(filename, 'r+b') as dst:
+        dst.write(src.read())
+        dst.truncate()
+    os.utime(filename, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert (os.stat(filename).st_ino, os.stat(filename).st_size) == (st.st_ino, st.st_size)
+
+    assert Parquet.readFile(filename)['site'].tolist() == ['SITE-B'] * 10
+
+
+def test_read_file_after_a_size_change(tmp_path):
+    filename = write(frame(), tmp_path / 'a.parquet')
+    Parquet.readFile(filename)
+    st = os.stat(filename)
+
+    with open(filename, 'r+b') as f:
+        frame(20).to_parquet(f)
+        f.truncate()
+    os.utime(filename, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert os.stat(filename).st_size != st.st_size
+
+    assert len(Parquet.readFile(filename)) == 20
+
+
+def test_in_place_changes_do_not_reach_the_cache(tmp_path):
+    filename = write(frame(), tmp_path / 'a.parquet')
+    df = Parquet.readFile(filename)
+    df.loc[0, 'value'] = 100
+    df['site'] = df['site'].str.lower()
+    df.sort_values('value', ascending=False, inplace=True)
+    df.drop(columns='site', inplace=True)
+
+    other = Parquet.readFile(filename)
+    assert other['value'].tolist() == list(range(10))
+    assert other['site'].tolist() == ['SITE-A'] * 10
+
+
+def test_release_replaced(tmp_path):
+    generation = tmp_path / 'generations' / '2'
+    os.makedirs(generation)
+    kept = write(frame(), tmp_path / 'kept.parquet')
+    replaced = write(frame(), tmp_path / 'replaced.parquet')
+    Parquet.readFile(kept)
+    Parquet.readFile(replaced)
+    # the new generation links the unchanged file and has a new one instead of the other
+    os.link(kept, generation / 'kept.parquet')
+    write(frame(), generation / 'replaced.parquet')
+
+    releaseReplaced(str(generation))
+
+    assert [ident[:2] for ident in frameCache.entries] == [(os.stat(kept).st_dev, os.stat(kept).st_ino)]
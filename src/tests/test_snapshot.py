@@ -0,0 +1,124 @@
+import os
+import time
+
+import pytest
+
+import utils.snapshot as snapshot
+from utils.snapshot import Snapshot
+
+
+@pytest.fixture
+def location(tmp_path):
+    location = f'{tmp_path}/parquet/'
+    os.makedirs(f'{location}raw')
+    with open(f'{location}raw/metaDf.parquet', 'w') as f:
+        f.write('meta')
+    return location
+
+
+def publish(location, name, content):
+    with Snapshot(location) as generation:
+        with open(f'{generation}raw/{name}', 'w') as f:
+            f.write(content)
+        return generation.rstrip(os.sep)
+
+
+def test_publish_shares_the_unchanged_files(location):
+    first = publish(location, 'a.parquet', 'a')
+    second = publish(location, 'b.parquet', 'b')
+
+    assert snapshot.currentGeneration(location) == second
+    # taken from the location itself before the first generation, then linked
+    assert os.stat(f'{first}/raw/metaDf.parquet').st_ino == os.stat(f'{second}/raw/metaDf.parquet').st_ino
+    assert os.stat(f'{first}/raw/a.parquet').st_ino == os.stat(f'{second}/raw/a.parquet').st_ino
+    assert not os.path.exists(f'{first}/raw/b.parquet')
+    assert Snapshot.publishedAt(first) <= Snapshot.publishedAt(second)
+
+
+def test_link_skips_the_excluded_and_temporary_files(location):
+    os.makedirs(f'{location}http-cache')
+    for name in ['raw/half.parquet.tmp', 'jobs.json', 'http-cache/x']:
+        with open(f'{location}{name}', 'w') as f:
+            f.write('x')
+    generation = publish(location, 'a.parquet', 'a')
+
+    assert sorted(os.listdir(generation)) == [snapshot.PUBLISHED, 'raw']
+    assert sorted(os.listdir(f'{generation}/raw')) == ['a.parquet', 'metaDf.parquet']
+
+
+def test_failed_block_discards_the_generation(location):
+    current = publish(location, 'a.parquet', 'a')
+
+    with pytest.raises(ValueError):
+        with Snapshot(location) as generation:
+            with open(f'{generation}raw/a.parquet.tmp', 'w') as f:
+                f.write('half')
+            raise ValueError('failed query')
+
+    assert snapshot.currentGeneration(location) == current
+    assert not os.path.exists(generation)
+    assert os.listdir(f'{location}{snapshot.GENERATIONS}') == [os.path.basename(current)]
+    # the lock is released
+    assert Snapshot.lock.acquire(timeout=1)
+    Snapshot.lock.release()
+
+
+def test_failed_publish_is_raised(location, monkeypatch):
+    current = publish(location, 'a.parquet', 'a')
+
+    def fail(self):
+        raise OSError('no space left')
+    monkeypatch.setattr(Snapshot, 'publish', fail)
+    with pytest.raises(OSError):
+        publish(location, 'b.parquet', 'b')
+
+    assert snapshot.currentGeneration(location) == current
+    assert os.listdir(f'{location}{snapshot.GENERATIONS}') == [os.path.basename(current)]
+
+
+def test_prune_after_the_ttl(location, monkeypatch):
+    first = publish(location, 'a.parquet', 'a')
+    second = publish(location, 'b.parquet', 'b')
+    # the first one was replaced just now, the requests pinned to it can still read it
+    assert os.path.exists(first)
+
+    # the second one was published more than GENERATION_TTL ago
+    with open(os.path.join(second, snapshot.PUBLISHED), 'w') as f:
+        f.write(str(time.time_ns() - int((snapshot.GENERATION_TTL + 1) * 1e9)))
+    third = publish(location, 'c.parquet', 'c')
+
+    assert not os.path.exists(first)
+    # replaced by the third one just now
+    assert os.path.exists(second)
+    assert snapshot.currentGeneration(location) == third
+    with open(f'{third}/raw/a.parquet') as f:
+        assert f.read() == 'a'
+
+
+def test_prune_keeps_the_generations_being_built(location):
+    publish(location, 'a.parquet', 'a')
+    old = publish(location, 'b.parquet', 'b')
+    with open(os.path.join(old, snapshot.PUBLISHED), 'w') as f:
+        f.write(str(time.time_ns() - int((snapshot.GENERATION_TTL + 1) * 1e9)))
+    # not published, newer than the current one
+    building = f'{location}{snapshot.GENERATIONS}/{time.time_ns() + 10**12}'
+    os.makedirs(building)
+
+    publish(location, 'c.parquet', 'c')
+
+    assert os.path.exists(building)
+
+
+def test_watch_calls_the_listeners_from_one_thread(location, monkeypatch):
+    monkeypatch.setattr(snapshot, 'WATCH_INTERVAL', 0.01)
+    calls = []
+    first = snapshot.watch(lambda generation: calls.append(('first', generation)), location)
+    second = snapshot.watch(lambda generation: calls.append(('second', generation)), location)
+    assert first is second
+
+    generation = publish(location, 'a.parquet', 'a')
+    deadline = time.time() + 5
+    while len(calls) < 2 and time.time() < deadline:
+        time.sleep(0.01)
+
+    assert calls == [('first', generation), ('second', generation)]
@@ -0,0 +1,12 @@
+import time
+
+from model.Updater import ParquetUpdater
+
+# Standalone writer of the parquet cache.
+# Run it next to the web application started with UPDATER=external, e.g.
+#   python3 /src/updater.py
+# The web workers only read the published snapshot generations, see utils/snapshot.py
+if __name__ == '__main__':
+    updater = ParquetUpdater()
+    while updater.scheduler.thread.is_alive():
+        time.sleep(60)
@@ -66,7 +66,7 @@ def asnAnomalesPerSiteVisualisation(query_params):
             #site.py
 ###############################################
 
-def siteMeasurements(q, pq):
+def siteMeasurements(q):
   return dbc.Row(
                     dbc.Card([
                         dbc.CardHeader(html.H3(f'{q.upper()} network measurements',
@@ -74,7 +74,7 @@ def siteMeasurements(q, pq):
                         dbc.CardBody([
                             html.Div(
                                 dcc.Graph(id="site-plots-in-out", 
-                                figure=SitesOverviewPlots(q, pq),
+                                figure=SitesOverviewPlots(q),
                                 config={'displayModeBar': False},# remove Plotly buttons so that they don't ovelap with the legend
                                 className="site-plots site-inner-cont p-05")
                             )
@@ -5,35 +5,96 @@ import requests
 import os
 import pandas as pd
 import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, AsyncElasticsearch
 import getpass
 
 DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.000Z"
 INDICES = ['ps_packetloss', 'ps_owd', 'ps_throughput', 'ps_trace']
 
+# settings for the concurrent ES requests
+QUERY_WORKERS = 8
+QUERY_TIMEOUT = 60  # seconds per request
+QUERY_RETRIES = 3
+# number of time bins requested at once from a composite aggregation, which ES returns page by page
+BINS_PER_REQUEST = 12
+
+# settings of the ES clients
+# connections kept per node, enough for the concurrent requests of the two scheduler jobs
+# and the threads of the web server
+ES_POOL_SIZE = int(os.environ.get('ES_POOL_SIZE', 3 * QUERY_WORKERS))
+ES_RETRIES = 10
+# request timeouts per query class, in seconds
+ES_TIMEOUTS = {'search': 60,  # the lookups made by the pages
+               'aggregation': QUERY_TIMEOUT,  # a page of a composite aggregation
+               'scan': 5*60,  # each scroll request of a scan
+               'ping': 5}
+
+CREDENTIALS = '/etc/ps-dash/creds.key'
 user, passwd, mapboxtoken = None, None, None
-with open("/etc/ps-dash/creds.key") as f:
-    user = f.readline().strip()
-    passwd = f.readline().strip()
-    mapboxtoken = f.readline().strip()
-
-def ConnectES():
-    global user, passwd
+# the modules can be imported without the credentials (e.g. by the tests), the ES requests then fail
+try:
+    with open(CREDENTIALS) as f:
+        user = f.readline().strip()
+        passwd = f.readline().strip()
+        mapboxtoken = f.readline().strip()
+except FileNotFoundError:
+    print(f"{CREDENTIALS} not found.")
+
+def esSettings():
     credentials = (user, passwd)
-
+    if getpass.getuser() == 'petya':
+        settings = {'hosts': 'https://localhost:9200', 'verify_certs': False, 'max_retries': 20}
+    else:
+        settings = {'hosts': [{'host': 'atlas-kibana.mwt2.org', 'port': 9200, 'scheme': 'https'}],
+                    'max_retries': ES_RETRIES}
+    settings.update(http_auth=credentials,
+                    connections_per_node=ES_POOL_SIZE,
+                    http_compress=True,
+                    request_timeout=ES_TIMEOUTS['search'])
+    return settings
+
+
+# Creates a new client. The asynchronous one is meant for the asyncio code
+# and has to be closed by the caller, e.g. "async with ConnectES(asynchronous=True) as client:"
+def ConnectES(asynchronous=False):
     try:
-        if getpass.getuser() == 'petya':
-            es = Elasticsearch('https://localhost:9200', verify_certs=False, http_auth=credentials, max_retries=20)
-        else:
-            es = Elasticsearch([{'host': 'atlas-kibana.mwt2.org', 'port': 9200, 'scheme': 'https'}],
-                                http_auth=credentials, max_retries=10)
-        print('Success' if es.ping()==True else 'Fail')
+        if asynchronous:
+            return AsyncElasticsearch(**esSettings())
+        es = Elasticsearch(**esSettings())
+        print('Success' if es.options(request_timeout=ES_TIMEOUTS['ping']).ping()==True else 'Fail')
         return es
     except Exception as error:
         print (">>>>>> Elasticsearch Client Error:", error)
 
 
+_es = None
+_esLock = threading.Lock()
+
+# The client shared by the process. It is created on first use,
+# so importing this module does not wait for ES
+def getES():
+    global _es
+    if _es is None:
+        with _esLock:
+            if _es is None:
+                _es = ConnectES()
+    return _es
+
+
+# The shared client with the timeout of the query class (see ES_TIMEOUTS) or the given one
+def esClient(queryClass='search', timeout=None):
+    return getES().options(request_timeout=timeout or ES_TIMEOUTS[queryClass])
+
+
+# hp.es is still available and returns the shared client
+def __getattr__(name):
+    if name == 'es':
+        return getES()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 def timer(func):
     @functools.wraps(func)
@@ -47,6 +108,26 @@ def timer(func):
     return wrapper_timer
 
 
+def retry(func, *args, retries=QUERY_RETRIES, backoff=2, **kwargs):
+    for attempt in range(retries):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt == retries - 1:
+                raise
+            wait = backoff ** attempt
+            print(f"{func.__name__}{args} failed ({e}). Retrying in {wait} secs...")
+            time.sleep(wait)
+
+
+# Runs func(*args) for each tuple in argsList on a bounded thread pool.
+# Each call is retried on failure. The results keep the order of argsList.
+def runConcurrently(func, argsList, workers=QUERY_WORKERS, retries=QUERY_RETRIES):
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(retry, func, *args, retries=retries) for args in argsList]
+        return [f.result() for f in futures]
+
+
 def convertDate(dt):
     try:
         parsed_date = datetime.strptime(dt, DATE_FORMAT)
@@ -134,6 +215,18 @@ def GetTimeRanges(dateFrom, dateTo, intv=1):
     return tl
 
 
+# Splits the period into consecutive windows of the given length in minutes.
+# The last window ends at dateTo and may be shorter
+def GetTimeWindows(dateFrom, dateTo, minutes):
+    start, end = parse_datetime_multi(dateFrom), parse_datetime_multi(dateTo)
+    windows = []
+    while start < end:
+        stop = min(start + timedelta(minutes=minutes), end)
+        windows.append((start.strftime(DATE_FORMAT), stop.strftime(DATE_FORMAT)))
+        start = stop
+    return windows
+
+
 def CalcMinutes4Period(dateFrom, dateTo):
     time_delta = FindPeriodDiff(dateFrom, dateTo)
     return (time_delta.days*24*60 + time_delta.seconds//60)
@@ -155,7 +248,3 @@ def getValueField(idx):
         return 'throughput'
 
     return None
-
-
-
-es = ConnectES()
\ No newline at end of file
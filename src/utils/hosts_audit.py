@@ -14,16 +14,35 @@ VERIFY_TLS = False
 PORT = 443
 CONNECT_TIMEOUT = 3
 HTTP_TIMEOUT = aiohttp.ClientTimeout(total=5)
-RETRIES = 3
-BACKOFF = [0, 5, 15]
+# number of hosts probed at the same time, also the limit of the open HTTP connections
+CONCURRENCY = 32
+# new connections per second over all hosts
+RATE_LIMIT = 100
+# a host is probed again until it answers or its deadline passes
+HOST_DEADLINE = 20  # seconds
+RETRY_PAUSE = 2  # seconds
+# the addresses of a host are tried in parallel, each one started this much after the previous one (happy eyeballs)
+HAPPY_EYEBALLS_DELAY = 0.25  # seconds
+DNS_TTL = 300  # seconds
 STATUSES = ["ACTIVE_HTTP", "ACTIVE_TCP_ONLY", "UNREACHABLE_CANDIDATE", "RETIRED_DNS"]
 
-async def resolve(host):
-    with suppress(Exception):
-        return await asyncio.get_running_loop().getaddrinfo(
-            host, PORT, type=socket.SOCK_STREAM
-        )
-    return []
+
+# Spaces out the calls of acquire(), at most rate of them per second
+class RateLimiter(object):
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next = 0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            now = asyncio.get_running_loop().time()
+            wait = self.next - now
+            self.next = max(now, self.next) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
 
 async def tcp_connect(addr):
     try:
@@ -34,59 +53,131 @@ async def tcp_connect(addr):
     except Exception:
         return False
 
-async def http_probe(host):
-    try:
-        ctx = ssl.create_default_context()
-        async with aiohttp.ClientSession(timeout=HTTP_TIMEOUT) as s:
-            async with s.head(f"https://{host}/pscheduler", ssl=ctx) as resp:
+
+# The unique addresses, alternating between the address families as recommended by RFC 8305
+def interleave(addrs):
+    unique = list({a[4]: a for a in addrs}.values())
+    families = {}
+    for a in unique:
+        families.setdefault(a[0], []).append(a)
+    ordered = []
+    for i in range(max([len(f) for f in families.values()], default=0)):
+        ordered.extend([f[i] for f in families.values() if i < len(f)])
+    return ordered
+
+
+# Usage:
+#   async with Prober() as prober:
+#       result = await prober.audit_host(host)
+# All probes share one HTTP session and the rate limiter, and the DNS answers are cached
+class Prober(object):
+
+    def __init__(self, concurrency=CONCURRENCY, rate=RATE_LIMIT):
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate)
+        self.dns = {}
+        self.ssl = ssl.create_default_context()
+        self.session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency, ttl_dns_cache=DNS_TTL)
+        self.session = aiohttp.ClientSession(timeout=HTTP_TIMEOUT, connector=connector)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.session.close()
+
+    async def resolve(self, host):
+        if host not in self.dns:
+            addrs = []
+            with suppress(Exception):
+                addrs = await asyncio.get_running_loop().getaddrinfo(
+                    host, PORT, type=socket.SOCK_STREAM
+                )
+            self.dns[host] = interleave(addrs)
+        return self.dns[host]
+
+    # True as soon as one of the addresses accepts the connection, the other attempts are cancelled
+    async def tcp_connect(self, addrs):
+        async def attempt(i, addr):
+            await asyncio.sleep(i * HAPPY_EYEBALLS_DELAY)
+            await self.limiter.acquire()
+            return await tcp_connect(addr)
+
+        tasks = [asyncio.create_task(attempt(i, a)) for i, a in enumerate(addrs)]
+        try:
+            for t in asyncio.as_completed(tasks):
+                if await t:
+                    return True
+            return False
+        finally:
+            for t in tasks:
+                t.cancel()
+
+    async def http_probe(self, host):
+        try:
+            await self.limiter.acquire()
+            async with self.session.head(f"https://{host}/pscheduler", ssl=self.ssl) as resp:
                 return 200 <= resp.status < 500
-    except Exception:
-        return False
+        except Exception:
+            return False
 
+    async def audit_host(self, host):
+        print(f"Auditing {host}...")
+        # found_in_ES, netsite and rcsite are set by hosts_audit
+        result = {"host": host, "found_in_ES": False, "netsite": "-", "rcsite": "-"}
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + HOST_DEADLINE
+        addrs = await self.resolve(host)
+        if not addrs:
+            result["status"] = "RETIRED_DNS"
+            return result
 
+        try:
+            tcp_ok = http_ok = False
+            while True:
+                # the TCP and HTTP probes run at the same time
+                with suppress(asyncio.TimeoutError):
+                    tcp_ok, http_ok = await asyncio.wait_for(
+                        asyncio.gather(self.tcp_connect(addrs), self.http_probe(host)),
+                        timeout=max(deadline - loop.time(), 0))
+                if tcp_ok or http_ok or loop.time() + RETRY_PAUSE >= deadline:
+                    break
+                await asyncio.sleep(RETRY_PAUSE)
+            if http_ok:
+                result["status"] = "ACTIVE_HTTP"
+            elif tcp_ok:
+                result["status"] = "ACTIVE_TCP_ONLY"
+            else:
+                result["status"] = "UNREACHABLE_CANDIDATE"
 
-async def audit_host(host):
-    print(f"Auditing {host}...")
-    result = {"host": host}
-    result["found_in_ES"], result["netsite"], result["rcsite"] = qrs.hostFoundInES(host, LOOKBACK_DAYS, ES_INDICES)
-    addrs = await resolve(host)
-    if not addrs:
-        result["status"] = "RETIRED_DNS"
-        return result
+        except Exception as e:
+            print(e)
+            result["status"] = "ERROR"
+            return result
 
-    # Retry with backoff
-    try:
-        tcp_ok = http_ok = False
-        for i in range(RETRIES):
-            if i: await asyncio.sleep(BACKOFF[i])
-            # try each resolved address until one works
-            tcp_ok = any([await tcp_connect(a) for a in addrs])
-            http_ok = await http_probe(host)
-            if tcp_ok or http_ok:
-                break
-        if http_ok:
-            result["status"] = "ACTIVE_HTTP"
-        elif tcp_ok:
-            result["status"] = "ACTIVE_TCP_ONLY"
-        else:
-            result["status"] = "UNREACHABLE_CANDIDATE"
-            
-    except Exception as e:
-        print(e)
-        result["status"] = "ERROR"
         return result
-        
-    return result
 
-async def hosts_audit(hosts, concurrency=32):
+
+async def hosts_audit(hosts, concurrency=CONCURRENCY):
     sem = asyncio.Semaphore(concurrency)
-    async def wrapped(h):
-        async with sem:
-            return await audit_host(h)
-    return await asyncio.gather(*[wrapped(h) for h in hosts])
+    async with Prober(concurrency) as prober:
+        async def wrapped(h):
+            async with sem:
+                return await prober.audit_host(h)
+        # all hosts are looked up in ES at once, while they get probed
+        lookup = asyncio.create_task(qrs.hostsFoundInESAsync(hosts, LOOKBACK_DAYS, ES_INDICES))
+        results = await asyncio.gather(*[wrapped(h) for h in hosts])
+    try:
+        found = await lookup
+    except Exception as e:
+        print("Hosts lookup in ES failed:", e)
+        found = {}
+    for result in results:
+        result["found_in_ES"], result["netsite"], result["rcsite"] = found.get(result["host"], (False, "-", "-"))
+    return results
 
 async def audit(hosts_1):
     # run the audit and return results
     audited_hosts = await hosts_audit(hosts_1)
     return audited_hosts
-
@@ -0,0 +1,101 @@
+import gzip
+import hashlib
+import json
+import os
+import time
+
+import requests
+
+# Responses of the external sources (CRIC, psConfig) kept on disk.
+# They are revalidated with ETag / Last-Modified, so an unchanged payload is not downloaded again,
+# and each one carries the sha256 of its content, so that the callers can skip the parsing
+# and the writes when it is the same as the one they processed last time.
+HTTP_CACHE = 'parquet/http-cache/'
+# With HTTP_CACHE_MODE=offline the cached responses are replayed and nothing is requested,
+# e.g. to run the updater without access to the sources
+OFFLINE = os.environ.get('HTTP_CACHE_MODE') == 'offline'
+
+
+class CachedResponse(object):
+
+    def __init__(self, url, content, digest, cached):
+        self.url = url
+        self.content = content
+        self.digest = digest
+        # True when the content comes from the cache (not modified or offline)
+        self.cached = cached
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class HttpCache(object):
+
+    def __init__(self, location=HTTP_CACHE, offline=OFFLINE, timeout=120, verify=False):
+        self.location = location
+        self.offline = offline
+        self.timeout = timeout
+        self.verify = verify
+        os.makedirs(location, exist_ok=True)
+
+    def paths(self, url):
+        key = hashlib.sha1(url.encode()).hexdigest()
+        return os.path.join(self.location, f'{key}.json'), os.path.join(self.location, f'{key}.gz')
+
+    # The cached response is ignored when the body is not the one described by the meta file
+    # (e.g. after a crash between the two writes), so its ETag is never sent for another content
+    def load(self, url):
+        metaFile, bodyFile = self.paths(url)
+        try:
+            with open(metaFile) as f:
+                meta = json.load(f)
+            with gzip.open(bodyFile, 'rb') as f:
+                content = f.read()
+        except (FileNotFoundError, OSError, ValueError):
+            return None, None
+        if hashlib.sha256(content).hexdigest() != meta.get('digest'):
+            print(f"The cached response of {url} is incomplete, ignoring it")
+            return None, None
+        return meta, content
+
+    # The body is on disk before the meta file describing it gets replaced
+    def save(self, url, meta, content):
+        metaFile, bodyFile = self.paths(url)
+        with open(f'{bodyFile}.tmp', 'wb') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb') as f:
+                f.write(content)
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(f'{bodyFile}.tmp', bodyFile)
+        with open(f'{metaFile}.tmp', 'w') as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f'{metaFile}.tmp', metaFile)
+
+    def get(self, url):
+        meta, content = self.load(url)
+        if self.offline:
+            if content is None:
+                raise FileNotFoundError(f"{url} is not in the HTTP cache")
+            return CachedResponse(url, content, meta['digest'], True)
+
+        headers = {'Accept-Encoding': 'gzip'}
+        if content is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        r = requests.get(url, headers=headers, timeout=self.timeout, verify=self.verify)
+        if r.status_code == 304 and content is not None:
+            print(f"Not modified: {url}")
+            return CachedResponse(url, content, meta['digest'], True)
+        r.raise_for_status()
+
+        digest = hashlib.sha256(r.content).hexdigest()
+        self.save(url, {'url': url,
+                        'etag': r.headers.get('ETag'),
+                        'last_modified': r.headers.get('Last-Modified'),
+                        'digest': digest,
+                        'fetched': round(time.time(), 3)}, r.content)
+        return CachedResponse(url, r.content, digest, False)
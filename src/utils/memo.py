@@ -0,0 +1,82 @@
+import json
+import threading
+from collections import OrderedDict
+
+from plotly.utils import PlotlyJSONEncoder
+
+import utils.snapshot as snapshot
+
+# memory available for the payloads kept by PageCache
+PAGE_CACHE_BUDGET = 256 * 1024**2  # bytes
+
+
+# Process-wide cache of the page payloads (figures, tables and other components).
+# The key starts with the snapshot generation the payload was built from, followed by the
+# name of the page part and the request parameters, so a new generation is never served stale data.
+# The payloads are kept as JSON, the way Dash sends them to the browser: an entry cannot be
+# changed by the callbacks which use it and its size is known.
+# The least recently used entries are evicted when the memory budget is exceeded.
+class PageCache(object):
+
+    def __init__(self, budget=PAGE_CACHE_BUDGET):
+        self.budget = budget
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+        return json.loads(entry)
+
+    def put(self, key, payload):
+        entry = json.dumps(payload, cls=PlotlyJSONEncoder)
+        if len(entry) > self.budget:
+            return entry
+        with self.lock:
+            self.pop(key)
+            self.entries[key] = entry
+            self.size += len(entry)
+            while self.size > self.budget:
+                oldest = next(iter(self.entries))
+                self.pop(oldest)
+        return entry
+
+    # expects the lock to be held
+    def pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    # Keeps only the entries for which keep(key) is True
+    def retain(self, keep):
+        with self.lock:
+            for key in [k for k in self.entries if not keep(k)]:
+                self.pop(key)
+
+    # The payload of name for the given parameters, built by build() when it is not cached.
+    # The returned payload is the JSON form, also the first time, so the result does not
+    # depend on whether it came from the cache
+    def memoize(self, name, params, build):
+        key = (snapshot.pinned(), name, *params)
+        payload = self.get(key)
+        if payload is None:
+            payload = json.loads(self.put(key, build()))
+        return payload
+
+
+pageCache = PageCache()
+
+
+# Drops the payloads built from the generations other than the given one.
+# Used as a snapshot.watch() listener, so the memory is released once new data is published
+def releasePages(generation):
+    pageCache.retain(lambda key: key[0] == generation)
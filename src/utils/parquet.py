@@ -1,33 +1,127 @@
 import dask.dataframe as dd
 import traceback
 import glob
+import os
+import threading
+from collections import OrderedDict
 import pandas as pd
 import pyarrow as pa
 import pyarrow.parquet as pq
 
 from utils.helpers import DATE_FORMAT
+import utils.snapshot as snapshot
+
+# The frames of FrameCache are shared by the callers of readFile through shallow copies.
+# With Copy-on-Write an in-place change (.loc, inplace=True) copies the data first,
+# so it never reaches the cached frame. It is always on from pandas 3.0
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.options.mode.copy_on_write = True
+
+# memory available for the frames kept by FrameCache
+CACHE_BUDGET = 4 * 1024**3  # bytes
+
+
+# Process-wide cache of the frames read from the parquet files.
+# The entries are stored by inode, so the files shared by several snapshot generations
+# are parsed once. An entry is valid as long as the file keeps the same modification time and size.
+# The least recently used entries are evicted when the memory budget is exceeded.
+class FrameCache(object):
+
+    def __init__(self, budget=CACHE_BUDGET):
+        self.budget = budget
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, ident, key):
+        with self.lock:
+            entry = self.entries.get(ident)
+            if entry is None or entry[0] != key:
+                return None
+            self.entries.move_to_end(ident)
+            return entry[1]
+
+    def put(self, ident, key, df):
+        nbytes = int(df.memory_usage(deep=True).sum())
+        if nbytes > self.budget:
+            return
+        with self.lock:
+            self.pop(ident)
+            self.entries[ident] = (key, df, nbytes)
+            self.size += nbytes
+            while self.size > self.budget:
+                oldest = next(iter(self.entries))
+                self.pop(oldest)
+
+    # expects the lock to be held
+    def pop(self, ident):
+        entry = self.entries.pop(ident, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    # Keeps only the entries for which keep(ident) is True
+    def retain(self, keep):
+        with self.lock:
+            for ident in [i for i in self.entries if not keep(i)]:
+                self.pop(ident)
+
+
+frameCache = FrameCache()
+
+
+# Drops the cached frames of the files which were replaced in the given generation.
+# Used as a snapshot.watch() listener, so the memory is not held until the LRU eviction.
+# Only the parquet files are looked at and nothing is done while the cache is empty
+def releaseReplaced(generation):
+    if not frameCache.entries:
+        return
+    live = set()
+    for root, dirs, files in os.walk(generation):
+        for f in files:
+            if f.endswith('.parquet'):
+                st = os.stat(os.path.join(root, f))
+                live.add((st.st_dev, st.st_ino))
+    frameCache.retain(lambda ident: ident[:2] in live)
+
 
 class Parquet(object):
     
+    # With nativeDates the datetime columns are stored as timestamps
+    # instead of being formatted as DATE_FORMAT strings.
+    # The data is written to a temporary file which then replaces the existing one,
+    # so the readers (and the older snapshot generations) keep the previous content
     @staticmethod
-    def writeToFile(df, filename):
+    def writeToFile(df, filename, nativeDates=False):
         try:
             # Convert date columns to the desired format
-            for col in df.select_dtypes(include=['datetime']):
-                df[col] = df[col].dt.strftime(DATE_FORMAT)
+            if not nativeDates:
+                for col in df.select_dtypes(include=['datetime']):
+                    df[col] = df[col].dt.strftime(DATE_FORMAT)
             if 'all_alarm_ids_src' in df.columns:
-                df['all_alarm_ids_src'] = df['all_alarm_ids_src'].apply(lambda x: ', '.join(map(str, x)))
-                df['all_alarm_ids_dest'] = df['all_alarm_ids_dest'].apply(lambda x: ', '.join(map(str, x)))
+                # the values are already joined when the rows were read back from a file
+                df['all_alarm_ids_src'] = df['all_alarm_ids_src'].apply(lambda x: x if isinstance(x, str) else ', '.join(map(str, x)))
+                df['all_alarm_ids_dest'] = df['all_alarm_ids_dest'].apply(lambda x: x if isinstance(x, str) else ', '.join(map(str, x)))
             table = pa.Table.from_pandas(df, preserve_index=True)
-            pq.write_table(table, filename)
+            tmp = f'{filename}.tmp'
+            pq.write_table(table, tmp)
+            with open(tmp, 'rb') as f:
+                os.fsync(f.fileno())
+            os.replace(tmp, filename)
             print(f"Successfully wrote to file: {filename}")
         except Exception as e:
+            # raised, so that the snapshot generation being built is discarded
             print(f"Error writing to file: {filename}, Exception: {e}")
+            raise
 
     @staticmethod
     def readSequenceOfFiles(location, prefix):
         try:
-            files = glob.glob(f"{location}{prefix}*")
+            files = glob.glob(f"{snapshot.resolve(location)}{prefix}*")
             df = dd.read_parquet(files).compute()
             # Convert date columns to datetime objects
             for col in df.select_dtypes(include=['object']):
@@ -39,27 +133,106 @@ class Parquet(object):
         except Exception as e:
             print(traceback.format_exc())
     
+    # Returns the content of the file. The parsed frames are shared through frameCache,
+    # so the callers receive a shallow copy, which Copy-on-Write keeps apart from the cached frame.
+    # With nativeDates columns "to" and "from" are returned as datetime64[ns, UTC],
+    # otherwise as DATE_FORMAT strings.
+    # The paths under parquet/ are read from the generation pinned by the request
+    @staticmethod
+    def readFile(filename, cache=True, nativeDates=False):
+        try:
+            filename = snapshot.resolve(filename)
+            st = os.stat(filename)
+            inode, key = (st.st_dev, st.st_ino, nativeDates), (st.st_mtime_ns, st.st_size)
+            df = frameCache.get(inode, key) if cache else None
+            if df is None:
+                df = Parquet.loadFile(filename, nativeDates)
+                if cache and df is not None:
+                    frameCache.put(inode, key, df)
+            return df.copy(deep=False) if df is not None else None
+        except FileNotFoundError:
+            print(f"{filename} not found.")
+            return dd.from_pandas(pd.DataFrame())
+        except Exception as e:
+            print(traceback.format_exc())
+
     @staticmethod
-    def readFile(filename):
+    def loadFile(filename, nativeDates=False):
         try:
             # df = dd.read_parquet(filename).compute()
-            df = pq.read_table(filename).to_pandas()
-            # Convert date columns to datetime objects
-            if 'to' in df.columns:
+            table = pq.read_table(filename)
+            df = table.to_pandas()
+            # Convert date columns to datetime objects.
+            # The files written with nativeDates already keep them as timestamps
+            for col in ['to', 'from']:
+                if col not in df.columns:
+                    continue
                 try:
-                    df['to'] = pd.to_datetime(df['to'], utc=True)
-                    df['to'] = df['to'].dt.strftime(DATE_FORMAT)
-                except ValueError:
-                    pass
-            if 'from' in df.columns:
-                try:
-                    df['from'] = pd.to_datetime(df['from'], utc=True)
-                    df['from'] = df['from'].dt.strftime(DATE_FORMAT)
+                    if not pa.types.is_timestamp(table.schema.field(col).type):
+                        df[col] = pd.to_datetime(df[col], utc=True, format='mixed')
+                    if not nativeDates:
+                        df[col] = df[col].dt.strftime(DATE_FORMAT)
                 except ValueError:
                     pass
             return df
         except FileNotFoundError:
-            print(f"{filename} not found.")
-            return dd.from_pandas(pd.DataFrame())
+            raise
         except Exception as e:
             print(traceback.format_exc())
+
+    # Stores the data as one file per day (location/YYYY-MM-DD.parquet) based on the given column.
+    # When append is True, the rows are added to the existing day files,
+    # so only the days present in df get rewritten.
+    # Columns "to" and "from" are stored as timestamp[ns, UTC]
+    @staticmethod
+    def writePartitions(df, location, column='to', append=True):
+        try:
+            os.makedirs(location, exist_ok=True)
+            df = df.copy(deep=False)
+            for col in ['to', 'from']:
+                if col in df.columns:
+                    if not isinstance(df[col].dtype, pd.DatetimeTZDtype):
+                        df[col] = pd.to_datetime(df[col], utc=True, format='mixed', errors='coerce')
+                    df[col] = df[col].astype('datetime64[ns, UTC]')
+            days = df[column].dt.floor('D')
+            for day, part in df.groupby(days):
+                filename = os.path.join(location, f"{day.strftime('%Y-%m-%d')}.parquet")
+                if append and os.path.exists(filename):
+                    stored = Parquet.readFile(filename, cache=False, nativeDates=True)
+                    if stored is None:
+                        raise IOError(f"Cannot read {filename}")
+                    part = pd.concat([stored, part])
+                # the rows are kept sorted, so that the row groups cover consecutive time ranges
+                part = part.sort_values(column, kind='stable')
+                Parquet.writeToFile(part, filename, nativeDates=True)
+        except Exception as e:
+            print(f"Error writing partitions to: {location}, Exception: {e}")
+            print(traceback.format_exc())
+            raise
+
+    # Reads the day files of the given location. When dateFrom and/or dateTo are set,
+    # only the days overlapping the period are read, the rest of the files are not opened.
+    # The rows of the first and last day still have to be filtered by the caller
+    @staticmethod
+    def readPartitions(location, nativeDates=False, dateFrom=None, dateTo=None):
+        files = sorted(glob.glob(os.path.join(snapshot.resolve(location), '*.parquet')))
+        if dateFrom is not None:
+            first = pd.to_datetime(dateFrom, utc=True).strftime('%Y-%m-%d')
+            files = [f for f in files if os.path.splitext(os.path.basename(f))[0] >= first]
+        if dateTo is not None:
+            last = pd.to_datetime(dateTo, utc=True).strftime('%Y-%m-%d')
+            files = [f for f in files if os.path.splitext(os.path.basename(f))[0] <= last]
+        frames = [Parquet.readFile(f, nativeDates=nativeDates) for f in files]
+        frames = [df for df in frames if isinstance(df, pd.DataFrame) and len(df) > 0]
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames)
+
+    # Removes the day files older than the given date (YYYY-MM-DD)
+    @staticmethod
+    def dropPartitions(location, before):
+        for f in glob.glob(os.path.join(location, '*.parquet')):
+            day = os.path.splitext(os.path.basename(f))[0]
+            if day < before:
+                os.remove(f)
+                print(f"Removed expired partition: {f}")
@@ -0,0 +1,203 @@
+import os
+import shutil
+import threading
+import time
+import traceback
+
+from flask import g, has_request_context
+
+# The cached data is published as generations: parquet/generations/<time in ns>/...
+# and parquet/current is a symlink to the latest complete one.
+# A new generation starts as hard links to the files of the current one, the updated
+# files are written next to them and when everything is on disk the link is flipped.
+# The readers never see a half-written file or the frames of one run with the pivots of another.
+LOCATION = 'parquet/'
+GENERATIONS = 'generations'
+CURRENT = 'current'
+# written to a generation when it gets published, holds the time of the publication in ns
+PUBLISHED = '.published'
+# the folders and files which are not part of the snapshots
+EXCLUDE = ['ml-datasets', 'http-cache', 'jobs.json', 'verified.json', GENERATIONS, CURRENT, PUBLISHED]
+# time a replaced generation is kept after its successor got published, so that the requests pinned to it can finish
+GENERATION_TTL = 10*60  # seconds
+# how often watch() checks if a new generation was published
+WATCH_INTERVAL = 10  # seconds
+
+
+def currentGeneration(location=LOCATION):
+    try:
+        return os.path.join(location, os.readlink(os.path.join(location, CURRENT)))
+    except OSError:
+        return None
+
+
+# The generation used by the current request. It is read once per request,
+# so that all files of a page come from the same generation
+def pinned():
+    if has_request_context():
+        if 'generation' not in g:
+            g.generation = currentGeneration()
+        return g.generation
+    return currentGeneration()
+
+
+# Maps a path under parquet/ to the same path in the given (or the pinned) generation.
+# Paths already in a generation and the excluded folders are returned as they are,
+# as well as all paths when no generation has been published yet
+def resolve(path, generation=None):
+    rel = os.path.relpath(path, LOCATION)
+    if rel.startswith('..') or rel.split(os.sep)[0] in EXCLUDE:
+        return path
+    generation = generation or pinned()
+    if generation is None:
+        return path
+    if rel == '.':
+        return generation + os.sep
+    return os.path.join(generation, rel) + (os.sep if path.endswith('/') else '')
+
+
+# the listeners of each location and the thread calling them, see watch()
+watchers = {}
+watchersLock = threading.Lock()
+
+
+# Calls listener(generation) each time a new generation gets published,
+# also when it is published by another process (see updater.py).
+# The current link is the notification, so the check is a single readlink.
+# All the listeners of a location share one thread and are called in the order they were registered
+def watch(listener, location=LOCATION):
+    with watchersLock:
+        if location not in watchers:
+            listeners = []
+            thread = threading.Thread(target=watchLoop, args=(location, listeners), name='snapshot-watch', daemon=True)
+            watchers[location] = (thread, listeners)
+            thread.start()
+        thread, listeners = watchers[location]
+        listeners.append(listener)
+    return thread
+
+
+def watchLoop(location, listeners):
+    last = currentGeneration(location)
+    while True:
+        time.sleep(WATCH_INTERVAL)
+        generation = currentGeneration(location)
+        if generation is not None and generation != last:
+            last = generation
+            with watchersLock:
+                called = list(listeners)
+            for listener in called:
+                try:
+                    listener(generation)
+                except Exception as e:
+                    print(traceback.format_exc())
+
+
+def fsyncDir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Usage:
+#   with Snapshot() as location:
+#       pq.writeToFile(df, f'{location}raw/metaDf.parquet')
+# The files have to be replaced (Parquet.writeToFile does it) and never modified in place,
+# because they are shared with the previous generations.
+# The data should be fetched before entering the block, which holds the lock until the generation is published.
+# A failure in the block or while publishing discards the generation and is raised
+class Snapshot(object):
+    # only one generation is built at a time, otherwise the changes of one job could be lost
+    lock = threading.Lock()
+
+    def __init__(self, location=LOCATION):
+        self.location = location
+        self.generation = None
+
+    def __enter__(self):
+        Snapshot.lock.acquire()
+        try:
+            # before the first generation, the files are taken from the location itself
+            base = currentGeneration(self.location) or self.location
+            self.generation = os.path.join(self.location, GENERATIONS, str(time.time_ns()))
+            self.link(base, self.generation)
+        except Exception:
+            Snapshot.lock.release()
+            raise
+        return self.generation + os.sep
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is not None:
+                self.discard()
+                return False
+            try:
+                for root, dirs, files in os.walk(self.generation):
+                    fsyncDir(root)
+                self.publish()
+            except Exception:
+                self.discard()
+                raise
+            try:
+                self.prune()
+            except Exception as e:
+                print(traceback.format_exc())
+        finally:
+            Snapshot.lock.release()
+        return False
+
+    def discard(self):
+        if currentGeneration(self.location) != self.generation:
+            print(f"Discarding {self.generation}")
+            shutil.rmtree(self.generation, ignore_errors=True)
+
+    @staticmethod
+    def link(base, target):
+        for root, dirs, files in os.walk(base):
+            rel = os.path.relpath(root, base)
+            if rel == '.':
+                dirs[:] = [d for d in dirs if d not in EXCLUDE]
+            os.makedirs(os.path.join(target, rel), exist_ok=True)
+            for f in files:
+                if not f.endswith('.tmp') and not (rel == '.' and f in EXCLUDE):
+                    os.link(os.path.join(root, f), os.path.join(target, rel, f))
+
+    def publish(self):
+        marker = os.path.join(self.generation, PUBLISHED)
+        with open(marker, 'w') as f:
+            f.write(str(time.time_ns()))
+            f.flush()
+            os.fsync(f.fileno())
+        tmp = os.path.join(self.location, f'{CURRENT}.tmp')
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.symlink(os.path.relpath(self.generation, self.location), tmp)
+        os.replace(tmp, os.path.join(self.location, CURRENT))
+        fsyncDir(self.location)
+        print(f"Published {self.generation}")
+
+    # The time (in ns) the generation was published, None if it was not
+    @staticmethod
+    def publishedAt(generation):
+        try:
+            with open(os.path.join(generation, PUBLISHED)) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return None
+
+    # Removes the generations replaced more than GENERATION_TTL ago, i.e. those followed by
+    # a generation published before that. The current one and those still being built are kept
+    def prune(self):
+        root = os.path.join(self.location, GENERATIONS)
+        generations = sorted(os.listdir(root))
+        now = time.time_ns()
+        replacedAt = None
+        for name in reversed(generations):
+            if replacedAt is not None and (now - replacedAt) / 1e9 > GENERATION_TTL:
+                shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+                continue
+            published = self.publishedAt(os.path.join(root, name))
+            if published is not None:
+                replacedAt = published if replacedAt is None else min(replacedAt, published)
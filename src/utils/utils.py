@@ -15,7 +15,8 @@ from collections import Counter
 import re
 import utils.helpers as hp
 from model.Alarms import Alarms
-from functools import lru_cache
+from model.SiteDirectory import SiteDirectory
+from model.MeasuresStore import MeasuresStore, UNITS
 from plotly.subplots import make_subplots
 from utils.parquet import Parquet
 from elasticsearch.helpers import scan
@@ -988,21 +989,10 @@ def extractAlarm(q, aInst=Alarms(), **other_unknown_query_strings):
 ####################################################
                 #pages/site.py
 ####################################################
-@lru_cache(maxsize=None)
-def loadAllTests(pq):
-    measures = pq.readFile('parquet/raw/measures.parquet')
-    return measures
-
-def SitesOverviewPlots(site_name, pq):
-    metaDf = pq.readFile('parquet/raw/metaDf.parquet')
-
-    alltests = loadAllTests(pq)
-
-    units = {
-    'ps_packetloss': 'packet loss',
-    'ps_throughput': 'MBps',
-    'ps_owd': 'ms'
-    }
+# the measures are partitioned per IP and index by MeasuresStore, once per file written by cacheIndexData,
+# with the dates and the throughput in MB computed at ingest
+def SitesOverviewPlots(site_name):
+    store = MeasuresStore.load()
 
     colors = ['#720026', '#e4ac05', '#00bcd4', '#1768AC', '#ffa822', '#134e6f', '#ff6150', '#1ac0c6', '#492b7c', '#9467bd',
             '#1f77b4', '#ff7f0e', '#2ca02c','#00224e', '#123570', '#3b496c', '#575d6d', '#707173', '#8a8678', '#a59c74',
@@ -1020,28 +1010,22 @@ def SitesOverviewPlots(site_name, pq):
 
     direction = {1: 'src', 2: 'dest'}
 
-    alltests['dt'] = pd.to_datetime(alltests['from'])
-
-    # convert throughput bites to MB
-    alltests.loc[alltests['idx']=='ps_throughput', 'value'] = alltests[alltests['idx']=='ps_throughput']['value'].apply(lambda x: round(x/1e+6, 2))
-
     # extract the data relevant for the given site name
-    ips = metaDf[(metaDf['site']==site_name) | (metaDf['netsite']==site_name)]['ip'].values
+    ips = SiteDirectory.load().ips(site_name)
+    slices = store.slices(ips)
     ip_colors = {ip: color for ip, color in zip(ips, colors)}
 
 
     legend_names = set()
 
     for col in [1,2]:
-        measures = alltests[alltests[direction[col]].isin(ips)].copy().sort_values('from', ascending=False)
-
         for i, ip in enumerate(ips):
             # The following code sets the visibility to True only for the first occurrence of an IP
             first_time_seen = ip not in legend_names
             not_on_legend = True
             legend_names.add(ip)
 
-            throughput = measures[(measures[direction[col]]==ip) & (measures['idx']=='ps_throughput')]
+            throughput = slices[(direction[col], ip, 'ps_throughput')]
             
             if not throughput.empty:
                 showlegend = first_time_seen==True and not_on_legend==True
@@ -1066,7 +1050,7 @@ def SitesOverviewPlots(site_name, pq):
                     row=1, col=col
                 )
             
-            packetloss = measures[(measures[direction[col]]==ip) & (measures['idx']=='ps_packetloss')]
+            packetloss = slices[(direction[col], ip, 'ps_packetloss')]
             if not packetloss.empty:
                 showlegend = first_time_seen==True and not_on_legend==True
                 not_on_legend = False
@@ -1090,7 +1074,7 @@ def SitesOverviewPlots(site_name, pq):
                     row=2, col=col
                 )
 
-            owd = measures[(measures[direction[col]]==ip) & (measures['idx']=='ps_owd')]
+            owd = slices[(direction[col], ip, 'ps_owd')]
             if not owd.empty:
                 showlegend = first_time_seen==True and not_on_legend==True
                 not_on_legend = False
@@ -1139,9 +1123,9 @@ def SitesOverviewPlots(site_name, pq):
 
 
     # Update yaxis properties
-    fig.update_yaxes(title_text=units['ps_throughput'], row=1, col=col)
-    fig.update_yaxes(title_text=units['ps_packetloss'], row=2, col=col)
-    fig.update_yaxes(title_text=units['ps_owd'], row=3, col=col)
+    fig.update_yaxes(title_text=UNITS['ps_throughput'], row=1, col=col)
+    fig.update_yaxes(title_text=UNITS['ps_packetloss'], row=2, col=col)
+    fig.update_yaxes(title_text=UNITS['ps_owd'], row=3, col=col)
     fig.layout.template = 'plotly_white'
     # py.offline.plot(fig)
 
@@ -1151,12 +1135,8 @@ def SitesOverviewPlots(site_name, pq):
          #pages/throughput.py
 #######################################
 def getRawDataFromES(src, dest, dateFrom, dateTo, ipv6):
-    pq = Parquet()
-    metaDf = pq.readFile('parquet/raw/metaDf.parquet')
-    sips = metaDf[(metaDf['site'] == src) | (metaDf['netsite'] == src)]['ip'].values.tolist()
-    sips = [ip.upper() for ip in sips] + [ip.lower() for ip in sips]
-    dips = metaDf[(metaDf['site'] == dest) | (metaDf['netsite'] == dest)]['ip'].values.tolist()
-    dips = [ip.upper() for ip in dips] + [ip.lower() for ip in dips]
+    directory = SiteDirectory.load()
+    sips, dips = directory.ipVariants(src), directory.ipVariants(dest)
 
     if len(sips) > 0 or len(dips) > 0:
         return qrs.queryBandwidthIncreasedDecreased(dateFrom, dateTo, sips, dips, ipv6)
@@ -1241,12 +1221,8 @@ def getSitePairs(alarm):
   return sitePairs
 
 def getRawDataFromES(src, dest, ipv6, dateFrom, dateTo):
-    pq = Parquet()
-    metaDf = pq.readFile('parquet/raw/metaDf.parquet')
-    sips = metaDf[(metaDf['site'] == src) | (metaDf['netsite'] == src)]['ip'].values.tolist()
-    sips = [ip.upper() for ip in sips] + [ip.lower() for ip in sips]
-    dips = metaDf[(metaDf['site'] == dest) | (metaDf['netsite'] == dest)]['ip'].values.tolist()
-    dips = [ip.upper() for ip in dips] + [ip.lower() for ip in dips]
+    directory = SiteDirectory.load()
+    sips, dips = directory.ipVariants(src), directory.ipVariants(dest)
 
     if len(sips) > 0 or len(dips) > 0:
       q = {
@@ -1285,7 +1261,7 @@ def getRawDataFromES(src, dest, ipv6, dateFrom, dateTo):
           }
       # print(str(q).replace("\'", "\""))
 
-      result = scan(client=hp.es,index='ps_throughput',query=q)
+      result = scan(client=hp.esClient('scan'),index='ps_throughput',query=q)
       data = []
 
       for item in result: